@@ -31,8 +31,7 @@
 #               parallel support: Done
 #               reduce reductant calculation
 #               Graphic card support?
-# Try matrix eigen solver in solve_psi - It's O(n^3), compared to what we
-# have for O(n^2) (or O(mn) where m for E resolution and n for x)
+# Matrix eigen solver: experimental (solve_psi_mtr, banded, O(n) per state)
 # replace CLIB by Cython
 
 from __future__ import division
@@ -41,17 +40,22 @@ __LOG__ = False
 __DEBUG__ = 1
 
 __USE_CLIB__ = True
-__MORE_INTERPOLATION__ = True  # One more time interpolation for eigen solver
+__MORE_INTERPOLATION__ = True  # Polish eigen energies (Illinois) in solve_psi
 __MULTI_PROCESSING__ = True
 
 import copy
 import sys
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from numpy import sqrt, exp, pi
-from scipy import interpolate
+from scipy import linalg, sparse
+from scipy.sparse.linalg import spsolve
+from scipy.optimize import linear_sum_assignment
+from scipy.signal import lfilter
 
 from settings import (wf_scale, psi_scale, wf_min_height, pretty_plot_factor,
-                      plot_decimate_factor, phonon_integral_factor)
+                      plot_decimate_factor)
 import MaterialConstantsDict
 cst = MaterialConstantsDict.MaterialConstantsDict()
 
@@ -66,23 +70,44 @@ if __DEBUG__ >= 1:
 if __USE_CLIB__:
     #  from ctypes import *
     import ctypes as ct
-    if __MULTI_PROCESSING__:
-        if sys.platform in ('linux2', 'darwin', 'cygwin'):
-            cQ = np.ctypeslib.load_library('cQCLayersMP', '.')
-        elif sys.platform == 'win32':
-            cQ = ct.CDLL('cQCLayersMP.dll')
-    else:
-        if sys.platform in ('linux2', 'darwin', 'cygwin'):
-            cQ = np.ctypeslib.load_library('cQCLayers', '.')
-        elif sys.platform == 'win32':
-            cQ = ct.CDLL('cQCLayers.dll')
+    try:
+        if __MULTI_PROCESSING__:
+            if sys.platform in ('linux2', 'darwin', 'cygwin'):
+                cQ = np.ctypeslib.load_library('cQCLayersMP', '.')
+            elif sys.platform == 'win32':
+                cQ = ct.CDLL('cQCLayersMP.dll')
+        else:
+            if sys.platform in ('linux2', 'darwin', 'cygwin'):
+                cQ = np.ctypeslib.load_library('cQCLayers', '.')
+            elif sys.platform == 'win32':
+                cQ = ct.CDLL('cQCLayers.dll')
+    except OSError:
+        # fall back to the NumPy backend (see psi_fn_vec)
+        print "unable to load cQCLayers, use NumPy instead"
+        __USE_CLIB__ = False
+
+if __USE_CLIB__:
+    # C function signatures, declared once
+    _ptr, _int, _dbl = ct.c_void_p, ct.c_int, ct.c_double
+    cQ.psiFn.argtypes = cQ.psiFnNumerov.argtypes = (
+        [_dbl, _int, _int, _dbl] + [_ptr] * 8)
+    cQ.psiFnEnd.argtypes = [_ptr, _int, _dbl, _int, _dbl, _dbl, _int
+                            ] + [_ptr] * 10
+    cQ.psiFnRoots.argtypes = [_ptr, _ptr, _int, _dbl, _dbl, _int, _dbl,
+                              _dbl, _int] + [_ptr] * 9
+    cQ.psiRootsFill.argtypes = cQ.psiFnRoots.argtypes + [_ptr]
+    cQ.psiFill.argtypes = [_int, _dbl, _int, _ptr, _dbl, _dbl, _int
+                           ] + [_ptr] * 8
+    cQ.inv_tau_int.argtypes = [_int, _dbl, _dbl, _ptr, _ptr, _ptr]
+    cQ.inv_tau_int.restype = _dbl
+    cQ.inv_tau_int_matrix.argtypes = [_int, _dbl] + [_ptr] * 7
 
 # ===========================================================================
 # Global Variables
 # ===========================================================================
 from scipy.constants import (e as e0, epsilon_0 as eps0,
                              electron_mass as m0, c as c0)
-from scipy.constants import h, hbar
+from scipy.constants import h, hbar, k as kb
 
 ANG = 1e-10    # angstrom to meter
 KVpCM = 1e5    # KV/cm to V/m
@@ -91,6 +116,28 @@ meV = 1e-3     # meV to eV
 INV_INF = 1e-20  # for infinit small decay rate (ns-1)
 PAD_HEAD = 100  # width padded in the head of the given region for basis solver
 PAD_TAIL = 30
+COARSE_STEP = 10   # coarse/fine ratio of energy step in solve_psi
+EIGEN_TOL = 0      # eV, tolerance for eigen energy polishing (0 to round off)
+SPLIT_TOL = 1e-9   # eV, min width of brackets split for multiple roots
+END_SLOPE = 200    # max |xyPsi'| (per angstrom) at the end of a bound state
+PSI_VEC_SIZE = 2**21  # max size of (x, energy) tables in psi_fn_vec
+NSTATES_BLOCK = 64  # coarse energy steps per block in solve_psi(nstates)
+WARM_WINDOW = 3    # coarse energy steps around old states in resolve_psi
+MTR_MASS_ITER = 8  # max Newton steps for mass in the matrix solver
+MTR_TOL = 1e-9     # eV, convergence of Newton steps for the mass
+MTR_INV_ITER = 1e-3  # eV, max Newton step to switch to inverse iteration
+MTR_DIFF = 1e-6    # eV, finite difference for dlambda/dE in matrix solver
+TRACK_MIN_OVERLAP = 0.5  # min wave function overlap to track a state
+FOLD_TOL = 5e-3    # eV, max energy mismatch for states folded into a period
+# support of a state in SparsePsi relative to max |psi|: the stored wave
+# functions are exact, but integrals between two states (LO phonon form
+# factors, dipoles, coupling energies) only run over the intersection of
+# their supports, which is fine only while SPARSE_TOL is tiny (1e-3 gives
+# dipole errors up to 7% on 8 periods of PQLiu). 0 for exact integrals
+SPARSE_TOL = 1e-4
+LO_KT_STEP = 2**0.25  # ratio of the energy grid of activated LO phonon rates
+LO_KT_NODES = 4    # Gauss-Laguerre nodes for thermal average of LO rates
+IFR_LAMBDA = 60    # angstrom, correlation length of interface roughness
 
 # ===========================================================================
 # Reference
@@ -101,6 +148,268 @@ PAD_TAIL = 30
 # [3]Peter Qiang Liu's thesis
 # ===========================================================================
 
+
+def kane_mass(Ek, Eg, F, Ep, ESO):
+    """Non-parabolic effective mass in unit m0 for kinetic energy Ek (in
+    unit eV), according to Eq.(2.20) in Kale's thesis. Arguments can be
+    arrays that broadcast together"""
+    return 1 / (1 + 2 * F + Ep / 3 * (2 / (Ek + Eg) + 1 / (Ek + Eg + ESO)))
+
+
+def start_point(Eq, E0, xPsiSize, xres, EField):
+    """Python version of startPoint in cQCLayers.c: the start point of the
+    wave function for energy Eq, s.t. the wave function starts in the
+    barrier before the first well it can be confined in. Eq can be an
+    array for multiple energies"""
+    if EField <= 0:
+        return np.ones_like(Eq, dtype=int)
+    extLength = 200  # angstrom
+    startpoint = xPsiSize - np.ceil(
+        (Eq - E0) / (EField * KVpCM * ANG * xres) + extLength / xres)
+    return np.clip(startpoint, 1, xPsiSize - 2).astype(int)
+
+
+def parallel_map(func, items, workers=None):
+    """[func(item) for item in items], computed by a pool of workers
+    threads if workers > 1 (the C solver releases the GIL)"""
+    if workers is None or workers <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+
+
+def steady_state(rates):
+    """Steady state populations of rate equations
+    dn_a/dt = sum_b n_b rates[b, a] - n_a sum_b rates[a, b] = 0,
+    normalized as sum_a n_a = 1
+    INPUT:
+        rates: list of square matrices, rates[k][a, b] is the scattering
+                rate from state a to b of the k-th system
+    OUTPUT:
+        list of populations n of each system, empty for a system without
+        states
+    All systems are solved together as one block diagonal sparse system
+    """
+    sizes = [W.shape[0] for W in rates]
+    blocks = []
+    for W in rates:
+        if W.shape[0] == 0:
+            continue
+        # transposed generator, the last equation is replaced by the
+        # normalization
+        G = W.T - np.diag(np.sum(W, axis=1))
+        G[-1] = 1
+        blocks.append(G)
+    if not blocks:
+        return [np.zeros(0) for W in rates]
+    rhs = np.zeros(sum(sizes))
+    rhs[np.cumsum([G.shape[0] for G in blocks]) - 1] = 1
+    n = spsolve(sparse.block_diag(blocks, format='csc'), rhs)
+    return np.split(np.atleast_1d(n), np.cumsum(sizes)[:-1])
+
+
+class SolverContext(object):
+    """Prepared structure for the C solver (cQCLayers), built from a
+    QCLayers object after populate_x_band. It holds the ctypes pointers of
+    the band arrays and the work buffers, so that repeated solves (sweeps,
+    optimizers) don't pay the setup and allocation on every call.
+    It's valid as long as the band arrays are not replaced (see
+    QCLayers.solver_context)
+    Member variables:
+        bands: (xVc, xEg, xF, xEp, xESO, xMc) of the structure
+        bandPtrs: ctypes pointers of bands
+        xMcE, xPsi: work buffers for the C functions
+    """
+    def __init__(self, qcl):
+        self.bands = (qcl.xVc, qcl.xEg, qcl.xF, qcl.xEp, qcl.xESO, qcl.xMc)
+        for a in self.bands:
+            assert a.dtype == np.float64 and a.flags['C_CONTIGUOUS']
+        self.bandPtrs = tuple(a.ctypes.data_as(ct.c_void_p)
+                              for a in self.bands)
+        self.xPsiSize = qcl.xVc.size
+        self.xMcE = np.zeros(self.xPsiSize)
+        self.xPsi = np.zeros(self.xPsiSize)
+        self.bufPtrs = (self.xMcE.ctypes.data_as(ct.c_void_p),
+                        self.xPsi.ctypes.data_as(ct.c_void_p))
+
+    def __deepcopy__(self, memo):
+        # ctypes pointers can't be copied, the copy will be rebuilt on demand
+        return None
+
+    def is_valid(self, qcl):
+        """If the context is for the current band arrays of qcl"""
+        return all(a is b for a, b in zip(self.bands, (
+            qcl.xVc, qcl.xEg, qcl.xF, qcl.xEp, qcl.xESO, qcl.xMc)))
+
+    def psi_end(self, Epoints, E0, xres, EField, numerov=False,
+                nodes=False):
+        """psiEnd[n] for energy Epoints[n], see psiFnEnd in cQCLayers.c.
+        If nodes is True, return (psiEnd, psiNodes) with the number of nodes
+        of the wave functions"""
+        Epoints = np.ascontiguousarray(Epoints, dtype=float)
+        psiEnd = np.empty(Epoints.size)
+        psiNodes = np.empty(Epoints.size, dtype=int)
+        cQ.psiFnEnd(Epoints.ctypes.data, Epoints.size, E0, self.xPsiSize,
+                    xres, EField, int(numerov), *(self.bandPtrs +
+                                                  self.bufPtrs +
+                                                  (psiEnd.ctypes.data,
+                                                   psiNodes.ctypes.data
+                                                   if nodes else None)))
+        if nodes:
+            return psiEnd, psiNodes
+        return psiEnd
+
+    def psi_roots(self, Elo, Ehi, E0, xres, EField, numerov=False):
+        """Eigen energies bracketed by [Elo[n], Ehi[n]], see psiFnRoots in
+        cQCLayers.c"""
+        Elo = np.ascontiguousarray(Elo, dtype=float)
+        Ehi = np.ascontiguousarray(Ehi, dtype=float)
+        roots = np.empty(Elo.size)
+        cQ.psiFnRoots(Elo.ctypes.data, Ehi.ctypes.data, Elo.size, E0,
+                      EIGEN_TOL, self.xPsiSize, xres, EField, int(numerov),
+                      *(self.bandPtrs + self.bufPtrs + (roots.ctypes.data,)))
+        return roots
+
+    def psi_roots_fill(self, Elo, Ehi, E0, xres, EField, numerov=False):
+        """psi_roots followed by psi_fill, in one (parallel) C call, see
+        psiRootsFill in cQCLayers.c
+        OUTPUT: (roots, xyPsi)"""
+        Elo = np.ascontiguousarray(Elo, dtype=float)
+        Ehi = np.ascontiguousarray(Ehi, dtype=float)
+        roots = np.empty(Elo.size)
+        xyPsi = np.empty((self.xPsiSize, Elo.size), order='F')
+        cQ.psiRootsFill(Elo.ctypes.data, Ehi.ctypes.data, Elo.size, E0,
+                        EIGEN_TOL, self.xPsiSize, xres, EField,
+                        int(numerov), *(self.bandPtrs + self.bufPtrs +
+                                        (roots.ctypes.data,
+                                         xyPsi.ctypes.data)))
+        return roots, xyPsi
+
+    def psi_fill(self, EigenE, E0, xres, EField, numerov=False):
+        """Normalized wave functions xyPsi[x, n] for EigenE[n], with the same
+        start point as psi_end, see psiFill in cQCLayers.c"""
+        EigenE = np.ascontiguousarray(EigenE, dtype=float)
+        xyPsi = np.empty((self.xPsiSize, EigenE.size), order='F')
+        cQ.psiFill(self.xPsiSize, xres, EigenE.size, EigenE.ctypes.data, E0,
+                   EField, int(numerov), *(self.bandPtrs + self.bufPtrs[:1] +
+                                           (xyPsi.ctypes.data,)))
+        return xyPsi
+
+
+class SparsePsi(object):
+    """Compact storage of wave functions xyPsi[x, n]: for each state only the
+    window [start[n], stop[n]) where psi is not zero is kept (lossless, the
+    solvers cut the tails to zero). The integrals between states (see
+    overlap) are only taken over the support window [intStart[n],
+    intStop[n]) where |psi| > tol * max|psi|
+    Member variables:
+        size: number of x points of the (dense) wave functions
+        start, stop: np.array of int, nonzero window of each state
+        data: wave functions in their windows, concatenated
+        offset: the wave function of state n is data[offset[n]:offset[n+1]]
+        intStart, intStop: np.array of int, support window of each state
+    """
+    def __init__(self, xyPsi, tol=SPARSE_TOL):
+        self.size = xyPsi.shape[0]
+        absPsi = np.abs(xyPsi)
+        self.start, self.stop = self.support(absPsi, 0)
+        self.intStart, self.intStop = self.support(
+            absPsi, tol * np.max(absPsi, axis=0))
+        self.offset = np.concatenate(([0], np.cumsum(self.stop -
+                                                     self.start)))
+        self.data = np.empty(self.offset[-1])
+        for n in xrange(self.start.size):
+            self.data[self.offset[n]:self.offset[n + 1]] = xyPsi[
+                self.start[n]:self.stop[n], n]
+
+    def support(self, absPsi, threshold):
+        """(start, stop) of the windows where absPsi > threshold"""
+        support = absPsi > threshold
+        nonzero = support.any(axis=0)
+        start = np.where(nonzero, np.argmax(support, axis=0), 0)
+        stop = np.where(nonzero, self.size - np.argmax(support[::-1], axis=0),
+                        0)
+        return start, stop
+
+    def __len__(self):
+        return self.start.size
+
+    def psi(self, n):
+        """The wave function of state n in its support window (view)"""
+        return self.data[self.offset[n]:self.offset[n + 1]]
+
+    def window(self, n, lo, hi):
+        """The wave function of state n on [lo, hi), a view if it's inside
+        the support window, otherwise a zero padded copy"""
+        if self.start[n] <= lo and hi <= self.stop[n]:
+            return self.data[self.offset[n] + lo - self.start[n]:
+                             self.offset[n] + hi - self.start[n]]
+        psi = np.zeros(hi - lo)
+        a, b = max(lo, self.start[n]), min(hi, self.stop[n])
+        if a < b:
+            psi[a - lo:b - lo] = self.window(n, a, b)
+        return psi
+
+    def overlap(self, i, j, pad=0):
+        """The intersection of the support windows (intStart, intStop) of
+        state i and j, extended by pad points at both sides
+        OUTPUT:
+            (lo, hi, psi_i, psi_j): the wave functions on [lo, hi), or
+            lo == hi and empty arrays if the two states don't overlap
+        """
+        lo = max(self.intStart[i], self.intStart[j])
+        hi = min(self.intStop[i], self.intStop[j])
+        if lo >= hi:
+            return lo, lo, np.zeros(0), np.zeros(0)
+        lo, hi = max(lo - pad, 0), min(hi + pad, self.size)
+        return lo, hi, self.window(i, lo, hi), self.window(j, lo, hi)
+
+    def todense(self):
+        """The dense wave functions xyPsi[x, n]"""
+        xyPsi = np.zeros((self.size, self.start.size))
+        for n in xrange(self.start.size):
+            xyPsi[self.start[n]:self.stop[n], n] = self.psi(n)
+        return xyPsi
+
+
+class BasisSegment(object):
+    """A part of the layer structure solved separately by basisSolve, with
+    only the data needed by convert_dCL_to_data and coupling_energy
+    Member variables:
+        EigenE, xyPsi: eigen solution of the part, with head/tail padding
+        xBarriers, xVc: see QCLayers.populate_x, for the part with padding
+        EField: external electric field, in unit kV/cm
+        widthOffset: position of the part in the whole structure, in unit
+                    angstrom
+        fieldOffset: energy offset of the part due to EField, in unit eV
+    Parts of repeated periods share the arrays with the part of the first
+    period, and only differ in offsets, see shift
+    """
+    def __init__(self, qcl, widthOffset):
+        self.EigenE = qcl.EigenE
+        self.xyPsi = qcl.xyPsi
+        self.xBarriers = qcl.xBarriers
+        self.xVc = qcl.xVc
+        self.EField = qcl.EField
+        self.set_offset(widthOffset)
+
+    def set_offset(self, widthOffset):
+        """Set widthOffset and the corresponding fieldOffset"""
+        self.widthOffset = widthOffset
+        self.fieldOffset = (-(widthOffset - PAD_HEAD) * ANG * self.EField *
+                            KVpCM)
+
+    def shift(self, width):
+        """The same part shifted by width (in unit angstrom), sharing the
+        arrays"""
+        segment = copy.copy(self)
+        segment.set_offset(self.widthOffset + width)
+        return segment
+
+
 # for In0.53Ga0.47As, EcG = 0.22004154
 #    use this as a zero point baseline
 bandBaseln = 0.22004154
@@ -140,6 +449,17 @@ class QCLayers(object):
                     for basis solver
         moleFrac: mole fraction for each possible layer material, in format
                     [well, barrier]*4
+        solverContext: cached SolverContext for the C solver, see
+                    solver_context
+        psiSparse: SparsePsi, the storage of the wave functions xyPsi
+        psiDense: cached dense xyPsi, rebuilt from psiSparse when needed
+        loRates: cached LO phonon scattering rates, see lo_rate_matrix
+        stateMass: cached effective mass of each state, see state_eff_mass
+        dipoles: cached optical dipoles, see dipole_matrix
+        xPointsPsi, plotStep: position of the rows of xyPsi and the
+                    decimation step for plotting, set by the eigen solvers
+        plotCache: cached arrays for plotting (xPointsPost, xyPsiPsi and
+                    xyPsiPlot), see plot_arrays
     """
     def __init__(self):
         self.layerWidth = np.array([1, 1])      # pix
@@ -168,11 +488,25 @@ class QCLayers(object):
         self.substrate = 'InP'
 
         self.moleFrac = [0.53, 0.52, 0.53, 0.52, 0.53, 0.52, 0.53, 0.52]
+        self.solverContext = None  # see solver_context
+        self.psiSparse = None  # see xyPsi
+        self.psiDense = None  # see xyPsi
+        self.loRates = None  # see lo_rate_matrix
+        self.stateMass = None  # see state_eff_mass
+        self.dipoles = None  # see dipole_matrix
+        self.plotCache = None  # see plot_arrays
 
         self.update_alloys()
         self.update_strain()
         self.populate_x()
 
+    def __getstate__(self):
+        # ctypes pointers in solverContext can't be pickled, it will be
+        # rebuilt on demand after loading (see solver_context)
+        state = self.__dict__.copy()
+        state['solverContext'] = None
+        return state
+
     def set_xres(self, res):
         for n in range(self.layerWidth.size):
             self.layerWidth[n] = int(np.round(
@@ -197,121 +531,101 @@ class QCLayers(object):
                        at xPoints[q] it's xLayerNums[q]-th layer
                     xLayerSelected: from layerSelected and xVc, xVc if it's
                         the layer indicated by layerSelected, otherwise NaN
+                    xInterfaces: index of interfaces, xPoints[q] with q in
+                        xInterfaces is the last point before the barrier/
+                        well changes
         """
         #  print "-----debug----- QCLayers populate_x called"
         #  print self.layerBarriers
-        self.xPoints = self.xres * np.arange(0, self.layerWidth.sum())
-
+        nLayers = self.layerWidth.size
         layerNumCumSum = np.concatenate(([0], self.layerWidth.cumsum()))
-        self.xBarriers = np.zeros(self.xPoints.shape)
-        self.xARs = np.zeros(self.xPoints.shape)
-        self.xMaterials = np.zeros(self.xPoints.shape)
-        self.xDopings = np.zeros(self.xPoints.shape)
-        self.xLayerNums = np.zeros(self.xPoints.shape)
-
-        # extend layer data for all xpoints
-        for q in xrange(0, self.layerWidth.size):
-            self.xBarriers[layerNumCumSum[q]:
-                           layerNumCumSum[q + 1]] = self.layerBarriers[q]
-            if self.layerARs[q] == 1:
-                self.xARs[layerNumCumSum[q] - 1:
-                          layerNumCumSum[q + 1] + 1] = 1
-            self.xMaterials[layerNumCumSum[q]:
-                            layerNumCumSum[q + 1]] = self.layerMaterials[q]
-            self.xDopings[layerNumCumSum[q]:
-                          layerNumCumSum[q + 1]] = self.layerDopings[q]
-            self.xLayerNums[layerNumCumSum[q]:
-                            layerNumCumSum[q + 1]] = q
-
-        # duplicate layer based on user input repeats
-        #  repeats = self.repeats
+        # index of layer at each x point, layers after the first one are
+        # duplicated based on user input repeats
+        xLayerNums = np.repeat(np.arange(nLayers), self.layerWidth)
+        # active region extends one point further on both sides (for the
+        # first layer the left end is index -1, as a slice)
+        ARCount = np.zeros(xLayerNums.size + 1)
+        ARLayers = np.nonzero(self.layerARs == 1)[0]
+        ARStart = layerNumCumSum[ARLayers] - 1
+        ARStart[ARStart < 0] += xLayerNums.size
+        ARStop = np.minimum(layerNumCumSum[ARLayers + 1] + 1, xLayerNums.size)
+        ARStart, ARStop = ARStart[ARStart < ARStop], ARStop[ARStart < ARStop]
+        np.add.at(ARCount, ARStart, 1)
+        np.add.at(ARCount, ARStop, -1)
+        xARs = (ARCount.cumsum()[:-1] > 0).astype(float)
         if self.repeats >= 2:
-            self.xPoints = np.arange(
-                0, self.xres * (self.layerWidth.sum() +
-                                self.layerWidth[1:].sum() * (
-                                    self.repeats - 1)),
-                self.xres)
-            self.xBarriers = np.concatenate((self.xBarriers, np.tile(
-                self.xBarriers[layerNumCumSum[1]:], self.repeats - 1)))
-            self.xARs = np.concatenate((self.xARs, np.tile(
-                self.xARs[layerNumCumSum[1]:], self.repeats - 1)))
-            self.xMaterials = np.concatenate((self.xMaterials, np.tile(
-                self.xMaterials[layerNumCumSum[1]:], self.repeats - 1)))
-            self.xDopings = np.concatenate((self.xDopings, np.tile(
-                self.xDopings[layerNumCumSum[1]:], self.repeats - 1)))
-            self.xLayerNums = np.concatenate((self.xLayerNums, np.tile(
-                self.xLayerNums[layerNumCumSum[1]:], self.repeats - 1)))
-
-        # this hack is needed because sometimes
-        # self.xPoints is one element too big
-        self.xPoints = self.xPoints[0:self.xBarriers.size]
+            xLayerNums = np.concatenate((xLayerNums, np.tile(
+                xLayerNums[layerNumCumSum[1]:], self.repeats - 1)))
+            xARs = np.concatenate((xARs, np.tile(
+                xARs[layerNumCumSum[1]:], self.repeats - 1)))
+
+        self.xPoints = self.xres * np.arange(xLayerNums.size)
+        self.xBarriers = self.layerBarriers.astype(float)[xLayerNums]
+        self.xARs = xARs
+        self.xMaterials = self.layerMaterials.astype(float)[xLayerNums]
+        self.xDopings = self.layerDopings.astype(float)[xLayerNums]
+        self.xLayerNums = xLayerNums.astype(float)
+        self.xInterfaces = np.nonzero(np.bitwise_xor(
+            self.xBarriers[0:-1].astype(bool),
+            self.xBarriers[1:].astype(bool)))[0]
 
         self.update_strain()
         # Following are equiv. elec potential for different bands
         # external field is included
         # xVX, xVL, xVLH and xVSO are used for checking if there's indrect
         # bandgap, s.t. we can prevent its effect
-        self.xVc = np.zeros(self.xPoints.size)
-        self.xVX = np.zeros(self.xPoints.size)
-        self.xVL = np.zeros(self.xPoints.size)
-        self.xVLH = np.zeros(self.xPoints.size)
-        self.xVSO = np.zeros(self.xPoints.size)
-        for MLabel in range(1, 5):
-            indx = np.nonzero(self.xMaterials == MLabel)[0]
-            if indx.size != 0:
-                material = np.where(self.xBarriers[indx] == 1,
-                                    MLabel * 2 - 1, (MLabel - 1) * 2)
-                self.xVc[indx] = (self.EcG[material] - self.xPoints[indx] *
-                                  ANG * self.EField * KVpCM)
-                self.xVX[indx] = (self.EcX[material] - self.xPoints[indx] *
-                                  ANG * self.EField * KVpCM)
-                self.xVL[indx] = (self.EcL[material] - self.xPoints[indx] *
-                                  ANG * self.EField * KVpCM)
-                self.xVLH[indx] = (self.EvLH[material] - self.xPoints[indx] *
-                                   ANG * self.EField * KVpCM)
-                self.xVSO[indx] = (self.EvSO[material] - self.xPoints[indx] *
-                                   ANG * self.EField * KVpCM)
+        material, valid = self.x_material_index()
+        xField = self.xPoints * ANG * self.EField * KVpCM
+        self.xVc = np.where(valid, self.EcG[material] - xField, 0)
+        self.xVX = np.where(valid, self.EcX[material] - xField, 0)
+        self.xVL = np.where(valid, self.EcL[material] - xField, 0)
+        self.xVLH = np.where(valid, self.EvLH[material] - xField, 0)
+        self.xVSO = np.where(valid, self.EvSO[material] - xField, 0)
 
         # make array to show selected layer in mainCanvas
+        self.xLayerSelected = np.zeros(self.xPoints.shape) * np.NaN
+        layerSelected = self.layerSelected
         try:
-            self.xLayerSelected = np.zeros(self.xPoints.shape) * np.NaN
-            layerSelected = self.layerSelected
-            if layerSelected != -1:
-                if layerSelected == 0:
-                    # row for first layer is selected
-                    for repeat in xrange(1, self.repeats + 1):
-                        base = layerNumCumSum[-1] * (repeat - 1)
-                        self.xLayerSelected[
-                            base + layerNumCumSum[layerSelected]:
-                            base + layerNumCumSum[layerSelected + 1] + 1
-                        ] = self.xVc[
-                            base + layerNumCumSum[layerSelected]:
-                            base + layerNumCumSum[layerSelected + 1] + 1
-                        ]
-                elif self.layerSelected == self.layerWidth.size:
-                    # last (blank) layer row is selected
-                    pass
-                else:
-                    for repeat in xrange(1, self.repeats + 1):
-                        base = np.sum(self.layerWidth[1:]) * (repeat - 1)
-                        self.xLayerSelected[
-                            base + layerNumCumSum[layerSelected] - 1:
-                            base + layerNumCumSum[layerSelected + 1] + 1
-                        ] = self.xVc[
-                            base + layerNumCumSum[layerSelected] - 1:
-                            base + layerNumCumSum[layerSelected + 1] + 1
-                        ]
+            if layerSelected == 0:
+                # row for first layer is selected
+                start = layerNumCumSum[0]
+                period = layerNumCumSum[-1]
+            elif layerSelected != -1 and layerSelected != nLayers:
+                # (last row for blank layer is not shown)
+                start = layerNumCumSum[layerSelected] - 1
+                period = layerNumCumSum[-1] - layerNumCumSum[1]
+            else:
+                start = None
+            if start is not None:
+                stop = layerNumCumSum[layerSelected + 1] + 1
+                indx = (period * np.arange(self.repeats)[:, np.newaxis] +
+                        np.arange(start, stop)).ravel()
+                indx = indx[(indx >= 0) & (indx < self.xPoints.size)]
+                self.xLayerSelected[indx] = self.xVc[indx]
         except IndexError:
             # index error happens in SolveBasis when the selected layer is
             # greater than the number of layers in the solve swath
             # however, xLayerSelected is not used for the SolveBasis function
-            #  print ("Index Error for layer selection at function"
-                #  "qclayer.populate_x")
             pass
 
         self.xARs[np.nonzero(self.xARs == 0)[0]] = np.NaN
         self.xARs *= self.xVc
 
+    def x_material_index(self):
+        """ Index of material at each x point in the material tables (EcG,
+        EgLH, me, etc., labeled by sequence [well, barrier]*4), from
+        xMaterials and xBarriers
+        OUTPUT:
+            (material, valid): material index, and if the material label is
+            valid (1 to 4); where not valid the index is 0 and the band
+            parameters should be left 0
+        """
+        MLabel = self.xMaterials.astype(int)
+        valid = (MLabel >= 1) & (MLabel <= 4)
+        material = np.where(self.xBarriers == 1, MLabel * 2 - 1,
+                            (MLabel - 1) * 2)
+        return np.where(valid, material, 0), valid
+
     def populate_x_band(self):
         """Extend layer information to position functions for band parameter
         OUTPUT/update member variables):
@@ -321,21 +635,12 @@ class QCLayers(object):
         """
         #  print "------debug------- QCLayers populate_x_band called"
         # Following parameters can be looked up in cQCLayers.c
-        self.xEg = np.zeros(self.xPoints.size)
-        self.xMc = np.zeros(self.xPoints.size)  # Seems not to be used
-        self.xESO = np.zeros(self.xPoints.size)
-        self.xEp = np.zeros(self.xPoints.size)
-        self.xF = np.zeros(self.xPoints.size)
-        for MLabel in range(1, 5):
-            indx = np.nonzero(self.xMaterials == MLabel)[0]
-            if indx.size != 0:
-                material = np.where(self.xBarriers[indx] == 1,
-                                    MLabel * 2 - 1, (MLabel - 1) * 2)
-                self.xEg[indx] = self.EgLH[material]
-                self.xMc[indx] = self.me[material]
-                self.xESO[indx] = self.ESO[material]
-                self.xEp[indx] = self.Ep[material]
-                self.xF[indx] = self.F[material]
+        material, valid = self.x_material_index()
+        self.xEg = np.where(valid, self.EgLH[material], 0)
+        self.xMc = np.where(valid, self.me[material], 0)  # Seems not used
+        self.xESO = np.where(valid, self.ESO[material], 0)
+        self.xEp = np.where(valid, self.Ep[material], 0)
+        self.xF = np.where(valid, self.F[material], 0)
 
     def update_alloys(self):  # c is a Material_Constant class instance
         """ update material parameter for the alloy used.
@@ -560,247 +865,831 @@ class QCLayers(object):
         self.me = 1 / ((1 + 2 * self.F) + self.Ep / self.EgLH * (
             self.EgLH + 2 / 3 * self.ESO) / (self.EgLH + self.ESO))
 
-    def eff_mass(self, E):
-        """Calculate effective mass according to energy E,
-        according to Eq.(2.20) in Kale's thesis
+    def eff_mass(self, E, lo=0, hi=None):
+        """Calculate effective mass according to energy E at
+        self.xPoints[lo:hi], according to Eq.(2.20) in Kale's thesis
         """
         #  xMcE = self.xMc * (1 - (self.xVc - E) / self.xEg)
-        xMcE = 1 / (1 + 2 * self.xF + self.xEp / 3 * (
-            2 / ((E - self.xVc) + self.xEg) + 1 / (
-                (E - self.xVc) + self.xEg + self.xESO)))
-        return xMcE
-
-    def solve_psi(self):
-        """ solve eigen modes
-        OUTPUT: (doesn't return, but update member variables
-            self.EigenE is the eignenergy of the layer structure
-            self.xPointsPost[x] is a shorter version of self.xPoints
-            self.xyPsi[x, n] is the wave function at position
-                    self.xPointsPost[x] corresiponding to the
-                    eigenenergy EigenE[n], and without solutions near zero
-            self.xyPsiPsi[x, n] is the scaled norm of xyPsi
-             -- and the above two also cut long zero heads and tials --
+        x = slice(lo, hi)
+        return kane_mass(E - self.xVc[x], self.xEg[x], self.xF[x],
+                         self.xEp[x], self.xESO[x])
+
+    def solution_cache(self, name, build):
+        """Return the cached value of member variable name, which is
+        rebuilt by build() when xyPsi is replaced (e.g. by a new solve).
+        Raise AttributeError if there is no solution yet"""
+        cache = getattr(self, name, None)
+        if cache is None or cache[0] is not self.psi_sparse():
+            cache = (self.psiSparse, build())
+            setattr(self, name, cache)
+        return cache[1]
+
+    def state_eff_mass(self):
+        """Return McE[n], the effective mass of state n (in unit m0), as
+        eff_mass(self.EigenE[n]) weighted by its probability density (in
+        its nonzero window, see SparsePsi). Cached until xyPsi is replaced
+        """
+        def build():
+            psiSparse = self.psiSparse
+            McE = np.empty(len(psiSparse))
+            for n in xrange(len(psiSparse)):
+                psi2 = psiSparse.psi(n)**2
+                McE[n] = np.sum(self.eff_mass(
+                    self.EigenE[n], psiSparse.start[n], psiSparse.stop[n]) *
+                    psi2) / np.sum(psi2)
+            return McE
+        return self.solution_cache('stateMass', build)
+
+    def solver_context(self):
+        """Return the SolverContext (prepared pointers and buffers for the C
+        solver) of the current band arrays. It's rebuilt only when the arrays
+        are replaced, e.g. by populate_x or populate_x_band"""
+        if (getattr(self, 'solverContext', None) is None or
+                not self.solverContext.is_valid(self)):
+            self.solverContext = SolverContext(self)
+        return self.solverContext
+
+    @property
+    def xyPsi(self):
+        """Dense wave functions xyPsi[x, n]. The solution is stored as
+        SparsePsi (see psi_sparse), and the dense array is only rebuilt when
+        it's needed (e.g. for plotting). Setting xyPsi replaces the solution.
+        Raise AttributeError if there is no solution yet"""
+        if self.psiSparse is None:
+            raise AttributeError("no wave functions solved")
+        if self.psiDense is None:
+            self.psiDense = self.psiSparse.todense()
+        return self.psiDense
+
+    @xyPsi.setter
+    def xyPsi(self, xyPsi):
+        self.psiSparse = SparsePsi(xyPsi)
+        self.psiDense = None
+
+    def psi_sparse(self):
+        """Return the SparsePsi (support windows) of the wave functions,
+        which is replaced with xyPsi (e.g. by a new solve)"""
+        if self.psiSparse is None:
+            raise AttributeError("no wave functions solved")
+        return self.psiSparse
+
+    def plot_arrays(self):
+        """Return (xPointsPost, xyPsiPsi, xyPsiPlot) derived from self.xyPsi
+        for plotting, cached until xyPsi is replaced (e.g. by a new solve).
+        They are only built when needed (by the GUI), so that headless solves
+        don't pay for them. Raise AttributeError if there is no solution yet
+        OUTPUT:
+            xPointsPost[x] is self.xPointsPsi decimated by self.plotStep
+            xyPsiPsi[x, n] is the scaled norm of xyPsi at xPointsPost[x]
+            xyPsiPlot[x, n] is the scaled xyPsi at xPointsPost[x]
+             -- the above two are NaN at long zero heads and tails --
              -- for better plot --
-            self.xyPsiPsi2[x, n] is a more precise version corresponding to
-                    position self.xPoints[x]
-        TODO: try matrix eigen solver?
         """
-        Epoints = np.arange(min(self.xVc),
-                            max(self.xVc - 115 * self.EField * 1e-5),
-                            self.vertRes / 1000)
-        xMcE = np.zeros(self.xPoints.shape)
-        xPsi = np.zeros(self.xPoints.shape)
-        psiEnd = np.zeros(Epoints.size)
-
-        # TODO: add adaptive spacing for Eq
+        def build():
+            xyPsi = self.xyPsi
+            # implement pretty plot:
+            # remove long zero head and tail of the wave functions
+            # |psi| > sqrt(pretty_plot_factor) <=> xyPsiPsi >
+            # wf_scale * pretty_plot_factor
+            pretty = np.abs(xyPsi) > np.sqrt(pretty_plot_factor)
+            first = np.argmax(pretty, axis=0)
+            last = xyPsi.shape[0] - 1 - np.argmax(pretty[::-1], axis=0)
+            # states without any pretty point are not plotted
+            last[~pretty.any(axis=0)] = 0
+
+            # decimate plot points: for better time and memory performance
+            idxs = np.arange(0, xyPsi.shape[0], self.plotStep, dtype=int)
+            xyPsiPlot = xyPsi[idxs, :] * psi_scale
+            xyPsiPsi = xyPsi[idxs, :]**2 * wf_scale
+            hidden = ((idxs[:, np.newaxis] < first) |
+                      (idxs[:, np.newaxis] >= last))
+            xyPsiPlot[hidden] = np.NaN
+            xyPsiPsi[hidden] = np.NaN
+            return self.xPointsPsi[idxs], xyPsiPsi, xyPsiPlot
+        return self.solution_cache('plotCache', build)
+
+    @property
+    def xPointsPost(self):
+        """Position of xyPsiPsi and xyPsiPlot, see plot_arrays"""
+        return self.plot_arrays()[0]
+
+    @property
+    def xyPsiPsi(self):
+        """Scaled norm of xyPsi for plotting, see plot_arrays"""
+        return self.plot_arrays()[1]
+
+    @property
+    def xyPsiPlot(self):
+        """Scaled xyPsi for plotting, see plot_arrays"""
+        return self.plot_arrays()[2]
+
+    def psi_fn_vec(self, Eqs, startpoints, numerov=False, full=True,
+                   nodes=False):
+        """Python version of psiFn (or psiFnNumerov if numerov is True) in
+        cQCLayers.c, vectorized: the recursion goes through x once, and each
+        step updates all energies Eqs[n] (starting from startpoints[n]) at
+        once. This is the NumPy backend of the shooting solver when the C
+        library is not used.
+        OUTPUT:
+            xPsi[x, n] is the (non-normalized) wave function for Eqs[n], or
+            only the end point xPsi[-1, n] if full is False (for numerov
+            it is at the end wall, see psiFnNumerov in cQCLayers.c)
+            If nodes is True (and full is False), return (xPsi[-1], count)
+            with count[n] the number of nodes of the wave function, see
+            psiNodes in cQCLayers.c
+        """
+        N = self.xPoints.size
+        chunk = max(1, PSI_VEC_SIZE // N)
+        if Eqs.size > chunk:
+            # limit the size of (x, energy) tables
+            parts = [self.psi_fn_vec(Eqs[k:k + chunk],
+                                     startpoints[k:k + chunk], numerov,
+                                     full, nodes)
+                     for k in xrange(0, Eqs.size, chunk)]
+            if nodes:
+                return tuple(np.concatenate(a) for a in zip(*parts))
+            return np.concatenate(parts, axis=-1)
+        starts = {}
+        for q in np.unique(startpoints):
+            starts[q] = np.nonzero(startpoints == q)[0]
+        if full:
+            xPsi = np.zeros((N, Eqs.size))
+        c = 2 * (self.xres * ANG / hbar)**2 * e0
+        xVc, xEg, xF, xEp, xESO = (self.xVc, self.xEg, self.xF, self.xEp,
+                                   self.xESO)
+        Ek = Eqs - xVc[:, np.newaxis]
+
+        def mass_table(Ek):
+            # eff_mass for all x and energies, with kinetic energy Ek[x, n]
+            return m0 * kane_mass(Ek, xEg[:, np.newaxis], xF[:, np.newaxis],
+                                  xEp[:, np.newaxis], xESO[:, np.newaxis])
+        prev = np.zeros(Eqs.size)
+        cur = np.zeros(Eqs.size)
+        count = np.zeros(Eqs.size, dtype=int)
+        last = np.zeros(Eqs.size)
+
+        def track(cur):
+            # count sign changes, zeros (before start point) are skipped
+            sign = np.sign(cur)
+            count[sign * last < 0] += 1
+            last[sign != 0] = sign[sign != 0]
+
+        if not numerov:
+            # see psiFn in cQCLayers.c, with mass at half points
+            xMcE = mass_table(Ek)
+            xMcE[1:-1] = 0.5 * (xMcE[1:-1] + xMcE[2:])
+            # xPsi[q+1] = A[q] * xPsi[q] - B[q] * xPsi[q-1]
+            A = np.empty(xMcE.shape)
+            A[1:] = xMcE[1:] * (-c * Ek[1:] + 1 / xMcE[1:] + 1 / xMcE[:-1])
+            B = np.empty(xMcE.shape)
+            B[1:] = xMcE[1:] / xMcE[:-1]
+            for q in xrange(1, N - 1):
+                if q in starts:
+                    cur[starts[q]] = 1
+                if full:
+                    xPsi[q] = cur
+                if nodes:
+                    track(cur)
+                prev, cur = cur, A[q] * cur - B[q] * prev
+            if full:
+                xPsi[-1] = cur
+                return xPsi
+            if nodes:
+                track(cur)
+                return cur, count
+            return cur
+
+        # see psiFnNumerov in cQCLayers.c, u = xPsi/sqrt(m)
+        same = ((xEg[:-1] == xEg[1:]) & (xF[:-1] == xF[1:]) &
+                (xEp[:-1] == xEp[1:]) & (xESO[:-1] == xESO[1:]))
+        mat = np.concatenate(([0], np.cumsum(~same)))
+        dV = np.diff(xVc)[same][0] if same.any() else 0
+        # inside[k]: k-1, k, k+1 are of the same material
+        inside = np.zeros(N, dtype=bool)
+        inside[1:-1] = same[:-1] & same[1:]
+        xMcE = mass_table(np.maximum(Ek, -xEg[:, np.newaxis] / 2))
+        sqrtM = sqrt(xMcE)
+        g = np.empty(xMcE.shape)
+        g[1:-1] = (-c * xMcE[1:-1] * Ek[1:-1] + sqrtM[1:-1] / sqrtM[2:] - 2 +
+                   sqrtM[1:-1] / sqrtM[:-2])
+
+        def V(k, r):
+            # potential at k for material at r, linearly extended
+            if 0 <= k < N and mat[k] == mat[r]:
+                return xVc[k]
+            return xVc[r] + (k - r) * dV
+
+        def M(v, r):
+            # mass at potential v for material at r, clipped at mid-gap
+            return m0 * kane_mass(np.maximum(Eqs - v, -xEg[r] / 2), xEg[r],
+                                  xF[r], xEp[r], xESO[r])
+
+        def G(k, r):
+            # g at k for material at r
+            v = V(k, r)
+            m = M(v, r)
+            return (c * m * (v - Eqs) + sqrt(m / M(V(k + 1, r), r)) - 2 +
+                    sqrt(m / M(V(k - 1, r), r)))
+
+        # the wall is half a point before startpoint - 1
+        q0 = np.min(startpoints) - 1
+        r = q0
+        g0, g1 = G(q0 - 1, r), G(q0, r)
+        for q in xrange(q0, N - 1):
+            if q + 1 in starts:
+                n = starts[q + 1]
+                cur[n] = 1 / sqrtM[q, n]
+                prev[n] = -cur[n] * (8 - g1[n]) / (8 - g0[n])
+            if full:
+                xPsi[q] = cur * sqrtM[q]
+            if nodes:
+                track(cur)
+            g2 = g[q + 1] if inside[q + 1] else G(q + 1, r)
+            nxt = (2 * (1 + 5 * g1 / 12) * cur -
+                   (1 - g0 / 12) * prev) / (1 - g2 / 12)
+            if mat[q + 1] == mat[r]:
+                prev, cur = cur, nxt
+                g0, g1 = g1, g2
+            else:
+                # interface between q and q+1
+                uMid = (cur + nxt) / 2 - (g1 * cur + g2 * nxt) / 16
+                duMid = nxt - cur - (g2 * nxt - g1 * cur) / 24
+                mA = M(V(q, r) + dV / 2, r)
+                sA = 1 / sqrt(mA)
+                dsA = 1 / sqrt(M(V(q + 1, r), r)) - 1 / sqrtM[q]
+                psi = uMid / sA
+                flux = (duMid / sA - uMid * dsA / sA**2) / mA
+                r = q + 1
+                mB = M(V(q + 1, r) - dV / 2, r)
+                sB = 1 / sqrt(mB)
+                dsB = 1 / sqrtM[q + 1] - 1 / sqrt(M(V(q, r), r))
+                uMid = psi * sB
+                duMid = flux * mB * sB + psi * dsB
+                g0, g1 = G(q, r), G(q + 1, r)
+                gMid = (g0 + g1) / 2
+                even = uMid + gMid * uMid / 8 + gMid**2 * uMid / 384
+                odd = duMid / 2 + ((g1 - g0) * uMid + gMid * duMid) / 48
+                prev, cur = even - odd, even + odd
+            big = np.abs(cur) > 1e100
+            if big.any():
+                # rescale to avoid overflow
+                prev[big] *= 1e-100
+                cur[big] *= 1e-100
+                if full:
+                    xPsi[:q + 1, big] *= 1e-100
+        # interpolate to the end wall, half a point after the last point
+        g2 = G(N, r)
+        nxt = (2 * (1 + 5 * g1 / 12) * cur -
+               (1 - g0 / 12) * prev) / (1 - g2 / 12)
+        end = (((cur + nxt) / 2 - (g1 * cur + g2 * nxt) / 16) *
+               sqrt(M(V(N - 1, r) + dV / 2, r)))
+        if full:
+            xPsi[-1] = end
+            return xPsi
+        if nodes:
+            track(end)
+            return end, count
+        return end
+
+    def psi_end(self, Epoints, E0, numerov=False, nodes=False):
+        """ Return the (non-normalized) wave function at the end of the
+        structure for energy Epoints[n], with the start point decided
+        by E0 and EField. psiEnd is zero for eigen energy.
+        numerov decides the ODE solver, see psi_fn_vec
+        If nodes is True, return (psiEnd, psiNodes), psiNodes[n] is the
+        number of nodes of the wave function, which increases by one at each
+        eigen energy (see psiNodes in cQCLayers.c)
+        """
         if __USE_CLIB__:
             # Call C function to get boundary dependence of energy EPoints[n],
             # the return value is psiEnd[n]
-            # for n with psiEnd[n]=0, EPoints[n] is eigenenergy
-            cQ.psiFnEnd(Epoints.ctypes.data_as(ct.c_void_p),
-                        int(Epoints.size), int(xPsi.size),
-                        ct.c_double(self.xres), ct.c_double(self.EField),
-                        self.xVc.ctypes.data_as(ct.c_void_p),
-                        self.xEg.ctypes.data_as(ct.c_void_p),
-                        self.xF.ctypes.data_as(ct.c_void_p),
-                        self.xEp.ctypes.data_as(ct.c_void_p),
-                        self.xESO.ctypes.data_as(ct.c_void_p),
-                        self.xMc.ctypes.data_as(ct.c_void_p),
-                        xMcE.ctypes.data_as(ct.c_void_p),
-                        xPsi.ctypes.data_as(ct.c_void_p),
-                        psiEnd.ctypes.data_as(ct.c_void_p))
-        else:
-            for p, Eq in enumerate(Epoints):
-                xMcE = m0 * self.eff_mass(Eq)
-                xMcE[0:-1] = 0.5 * (xMcE[0:-1] + xMcE[1:])
-                xPsi[0] = 0
-                xPsi[1] = 1
-                for q in xrange(1, xPsi.size - 1):
-                    xPsi[q + 1] = xMcE[q] * (
-                        (2 * (self.xres * ANG / hbar)**2 *
-                         (self.xVc[q] - Eq) * e0 + 1 / xMcE[q] +
-                         1 / xMcE[q - 1]) * xPsi[q] -
-                        xPsi[q - 1] / xMcE[q - 1])
-                psiEnd[p] = xPsi[-1]
+            return self.solver_context().psi_end(
+                Epoints, E0, self.xres, self.EField, numerov, nodes)
+        return self.psi_fn_vec(Epoints, start_point(
+            Epoints, E0, self.xPoints.size, self.xres, self.EField),
+            numerov, full=False, nodes=nodes)
+
+    def psi_roots(self, Elo, Ehi, E0, numerov=False):
+        """ Polish eigen energies bracketed by Elo[n] and Ehi[n] (psiEnd
+        changes sign in between) using Illinois method, see psiFnRoots in
+        cQCLayers.c. Start point is decided the same way as psi_end
+        """
+        if __USE_CLIB__:
+            return self.solver_context().psi_roots(
+                Elo, Ehi, E0, self.xres, self.EField, numerov)
+
+        def f(Eq):
+            return self.psi_fn_vec(Eq, start_point(
+                Eq, E0, self.xPoints.size, self.xres, self.EField),
+                numerov, full=False)
+        # all brackets are iterated together, until each of them converges
+        # (to the round off, see psiRoot in cQCLayers.c)
+        a, b = Elo.copy(), Ehi.copy()
+        fa, fb = f(a), f(b)
+        roots = np.where(np.abs(fa) < np.abs(fb), a, b)
+        side = np.zeros(Elo.size, dtype=int)
+        active = np.nonzero(b - a >= EIGEN_TOL)[0]
+        for _ in xrange(100):
+            c = ((a[active] * fb[active] - b[active] * fa[active]) /
+                 (fb[active] - fa[active]))
+            outside = ~((a[active] < c) & (c < b[active]))
+            c[outside] = 0.5 * (a[active] + b[active])[outside]
+            # a and b are next to each other
+            split = (a[active] < c) & (c < b[active])
+            active, c = active[split], c[split]
+            if active.size == 0:
+                break
+            roots[active] = c
+            fc = f(c)
+            sameSign = (fc > 0) == (fb[active] > 0)
+            fa[active[sameSign & (side[active] == -1)]] /= 2
+            fb[active[~sameSign & (side[active] == 1)]] /= 2
+            b[active[sameSign]] = c[sameSign]
+            fb[active[sameSign]] = fc[sameSign]
+            a[active[~sameSign]] = c[~sameSign]
+            fa[active[~sameSign]] = fc[~sameSign]
+            side[active] = np.where(sameSign, -1, 1)
+            active = active[(fc != 0) & (b[active] - a[active] >= EIGEN_TOL)]
+        return roots
+
+    def psi_brackets(self, Epoints, E0, numerov=False, first=0, last=None,
+                     mask=None):
+        """ Two level scan for eigen energies: psiEnd is first sampled on the
+        coarse grid Epoints, and vertRes is only used in coarse intervals
+        where psiEnd changes sign, the number of nodes of the wave function
+        changes, or next to a local minimum of |psiEnd| (possible
+        near-degenerate pair of roots). Fine intervals with more than one
+        root (by the number of nodes) are split by bisection, see
+        psi_split_brackets
+        INPUT:
+            Epoints: coarse energy grid
+            E0, numerov: see psi_end
+            first, last: only coarse intervals [Epoints[n], Epoints[n+1]]
+                    with first <= n < last are refined, the others are
+                    only used as neighbours (default all)
+            mask: if not None, boolean array of size Epoints.size - 1, only
+                    coarse intervals with mask True are refined (e.g.
+                    Epoints is a concatenation of several energy windows)
+        OUTPUT:
+            (Elo, Ehi, flo, fhi): brackets [Elo[n], Ehi[n]] of eigen energies
+                    and psiEnd (flo[n], fhi[n]) at both ends, sorted (empty
+                    if no coarse interval is refined)
+        """
+        psiEnd, nodes = self.psi_end(Epoints, E0, numerov, nodes=True)
         if __LOG__:
             global logcount
             with file("EpointsLog%d.pkl" % logcount, 'w') as logfile:
                 pickle.dump((Epoints, psiEnd), logfile)
             logcount += 1
             print "log saved for Epoints and psiEnd (%d)" % logcount
-        # TODO: maybe improved
-        tck = interpolate.splrep(Epoints, psiEnd)
-        self.EigenE = interpolate.sproot(tck, mest=len(Epoints))
-
-        if __MORE_INTERPOLATION__:
-            # Near the above approximation result,
-            # try to get a more precise result
-            xnear = np.empty(3 * len(self.EigenE))
-            fxnear = np.empty(3 * len(self.EigenE))
-            for q in xrange(self.EigenE.size):
-                # 100000 is an estimate for the precision of above
-                # approximation
-                # TODO: change the three calls of psiFn to loop
-                approxwidth = self.vertRes / 100000
-                xnear[3 * q: 3 * q + 3] = self.EigenE[q] + approxwidth * \
-                    np.arange(-1, 2)
-
-            for n, Eq in enumerate(xnear):
-                if __USE_CLIB__:
-                    cQ.psiFn(ct.c_double(Eq), int(1), int(xPsi.size),
-                             ct.c_double(self.xres),
-                             self.xVc.ctypes.data_as(ct.c_void_p),
-                             self.xEg.ctypes.data_as(ct.c_void_p),
-                             self.xF.ctypes.data_as(ct.c_void_p),
-                             self.xEp.ctypes.data_as(ct.c_void_p),
-                             self.xESO.ctypes.data_as(ct.c_void_p),
-                             self.xMc.ctypes.data_as(ct.c_void_p),
-                             xMcE.ctypes.data_as(ct.c_void_p),
-                             xPsi.ctypes.data_as(ct.c_void_p))
-                else:
-                    xMcE = self.eff_mass(Eq)
-                    xMcE[1:] = (xMcE[:-1] + xMcE[1:]) / 2
-                    xPsi[0] = 0
-                    for x in range(1, xPsi.size):
-                        # not tested.. C files are better
-                        xPsi[x] = (xPsi[x] * (2 * (self.xres * ANG / hbar)**2 *
-                                              (self.xVc[x] - Eq) * e0 +
-                                              1 / xMcE[x] + 1 / xMcE[n - 1]) -
-                                   xPsi[x - 1] / xMcE[x - 1]) * xMcE[x]
-                fxnear[n] = xPsi[-1]
-            idxs = 3 * np.arange(len(self.EigenE)) + 1
+        absEnd = np.abs(psiEnd)
+        dip = np.zeros(Epoints.size, dtype=bool)
+        dip[1:-1] = (absEnd[1:-1] < absEnd[:-2]) & (absEnd[1:-1] <= absEnd[2:])
+        refine = ((np.sign(psiEnd[:-1]) != np.sign(psiEnd[1:])) |
+                  (nodes[:-1] != nodes[1:]) | dip[:-1] | dip[1:])
+        refine[:first] = False
+        if last is not None:
+            refine[last:] = False
+        if mask is not None:
+            refine &= mask
+        idxs = np.nonzero(refine)[0]
+        if idxs.size == 0:
+            return (np.empty(0),) * 4
+
+        # fine grid in refined intervals, with coarse points as both ends
+        Efine = (Epoints[idxs, np.newaxis] + self.vertRes / 1000 *
+                 np.arange(COARSE_STEP + 1))
+        Efine[:, -1] = Epoints[idxs + 1]
+        psiFine = np.empty(Efine.shape)
+        nodesFine = np.empty(Efine.shape, dtype=int)
+        psiFine[:, 0], nodesFine[:, 0] = psiEnd[idxs], nodes[idxs]
+        psiFine[:, -1], nodesFine[:, -1] = psiEnd[idxs + 1], nodes[idxs + 1]
+        psiFine[:, 1:-1], nodesFine[:, 1:-1] = (a.reshape(idxs.size, -1) for a
+                                                in self.psi_end(
+            Efine[:, 1:-1].flatten(), E0, numerov, nodes=True))
+        return self.psi_split_brackets(
+            Efine[:, :-1].flatten(), Efine[:, 1:].flatten(),
+            psiFine[:, :-1].flatten(), psiFine[:, 1:].flatten(),
+            nodesFine[:, :-1].flatten(), nodesFine[:, 1:].flatten(),
+            E0, numerov)
+
+    def psi_split_brackets(self, Elo, Ehi, flo, fhi, nlo, nhi, E0,
+                           numerov=False):
+        """ Brackets of single eigen energies in the intervals [Elo[n],
+        Ehi[n]]: intervals with more than one root, i.e. the number of nodes
+        (nlo[n], nhi[n] at both ends, see psi_end) changes by more than one,
+        are split by bisection until each part has at most one root, or is
+        shorter than SPLIT_TOL. This resolves near-degenerate states closer
+        than vertRes
+        INPUT:
+            flo, fhi: psiEnd at both ends
+            E0, numerov: see psi_end
+        OUTPUT:
+            (Elo, Ehi, flo, fhi), see psi_brackets
+        """
+        brackets = []
+        while True:
+            split = ((np.abs(nhi - nlo) > 1) &
+                     (Ehi - Elo > SPLIT_TOL))
+            single = ~split & (np.sign(flo) != np.sign(fhi))
+            brackets.append((Elo[single], Ehi[single], flo[single],
+                             fhi[single]))
+            if not split.any():
+                break
+            Elo, Ehi, flo, fhi, nlo, nhi = (a[split] for a in (
+                Elo, Ehi, flo, fhi, nlo, nhi))
+            Emid = (Elo + Ehi) / 2
+            fmid, nmid = self.psi_end(Emid, E0, numerov, nodes=True)
+            Elo, Ehi, flo, fhi, nlo, nhi = (np.concatenate(a) for a in (
+                (Elo, Emid), (Emid, Ehi), (flo, fmid), (fmid, fhi),
+                (nlo, nmid), (nmid, nhi)))
+        Elo, Ehi, flo, fhi = (np.concatenate(a) for a in zip(*brackets))
+        order = np.argsort(Elo)
+        return Elo[order], Ehi[order], flo[order], fhi[order]
+
+    def psi_states(self, Elo, Ehi, flo, fhi, E0, numerov=False):
+        """ Eigen energies and normalized wave functions in the brackets
+        given by psi_brackets, without states from oscillating end points.
+        States whose wave function does not vanish at the end although they
+        are bound there (numerically lost in the fill) are dropped with a
+        printed warning
+        OUTPUT:
+            (EigenE, xyPsi), see solve_psi
+        """
+        if __MORE_INTERPOLATION__ and __USE_CLIB__:
+            # Polish the eigen energies inside the brackets and fill the
+            # wave functions, in one C call parallel over states
+            EigenE, xyPsi = self.solver_context().psi_roots_fill(
+                Elo, Ehi, E0, self.xres, self.EField, numerov)
+        else:
+            if __MORE_INTERPOLATION__:
+                EigenE = self.psi_roots(Elo, Ehi, E0, numerov)
+            else:
+                # linear interpolation inside the brackets
+                EigenE = (Elo * fhi - Ehi * flo) / (fhi - flo)
+
+            # make array for Psi and fill it in
             if __USE_CLIB__:
-                cQ.inv_quadratic_interp(
-                    xnear.ctypes.data_as(ct.c_void_p),
-                    fxnear.ctypes.data_as(ct.c_void_p),
-                    idxs.ctypes.data_as(ct.POINTER(ct.c_int)),
-                    int(idxs.size), self.EigenE.ctypes.data_as(ct.c_void_p))
+                # with eigenenregy EigenE, here call C function to get wave
+                # function
+                xyPsi = self.solver_context().psi_fill(
+                    EigenE, E0, self.xres, self.EField, numerov)
             else:
-                for q, idx in enumerate(idxs):
-                    # do quadratic interpolation
-                    x0 = xnear[idx - 1]
-                    fx0 = fxnear[idx - 1]
-                    x1 = xnear[idx]
-                    fx1 = fxnear[idx]
-                    x2 = xnear[idx + 1]
-                    fx2 = fxnear[idx + 1]
-                    # inverse quadratic interpolation
-                    x3 = (x0 * fx1 * fx2 / (fx0 - fx1) / (fx0 - fx2) +
-                          x1 * fx0 * fx2 / (fx1 - fx0) / (fx1 - fx2) +
-                          x2 * fx0 * fx1 / (fx2 - fx0) / (fx2 - fx1))
-                    self.EigenE[q] = x3
-
-        # make array for Psi and fill it in
-        if __USE_CLIB__:
-            # with eigenenregy EigenE, here call C function to get wave
-            # function
-            self.xyPsi = np.zeros(self.xPoints.size * self.EigenE.size)
-            cQ.psiFill(int(xPsi.size), ct.c_double(self.xres),
-                       int(self.EigenE.size),
-                       self.EigenE.ctypes.data_as(ct.c_void_p),
-                       self.xVc.ctypes.data_as(ct.c_void_p),
-                       self.xEg.ctypes.data_as(ct.c_void_p),
-                       self.xF.ctypes.data_as(ct.c_void_p),
-                       self.xEp.ctypes.data_as(ct.c_void_p),
-                       self.xESO.ctypes.data_as(ct.c_void_p),
-                       self.xMc.ctypes.data_as(ct.c_void_p),
-                       xMcE.ctypes.data_as(ct.c_void_p),
-                       self.xyPsi.ctypes.data_as(ct.c_void_p))
-            # self.xyPsi.resize(a.xPoints.size, a.EigenE.size)
-            self.xyPsi = self.xyPsi.reshape(self.xPoints.size,
-                                            self.EigenE.size, order='F')
-        else:
-            self.xyPsi = np.zeros((self.xPoints.size, self.EigenE.size))
-            for p, Eq in enumerate(self.EigenE):
-                xMcE = m0 * self.eff_mass(self.EigenE)
-                xMcE[0:-1] = 0.5 * (xMcE[0:-1] + xMcE[1:])
-                xPsi[1] = 1
-                for q in xrange(2, xPsi.size - 1):
-                    xPsi[q + 1] = ((2 * (self.xres * ANG / hbar)**2 *
-                                   (self.xVc[q] - Eq) * e0 + 1 / xMcE[q] +
-                                    1 / xMcE[q - 1]) * xPsi[q] -
-                                   xPsi[q - 1] / xMcE[q - 1]) * xMcE[q]
+                # with the same start point as for the eigen energy
+                startpoints = start_point(EigenE, E0, self.xPoints.size,
+                                          self.xres, self.EField)
+                xPsi = self.psi_fn_vec(EigenE, startpoints, numerov)
+                for n in xrange(EigenE.size):
+                    # cut the growing tail, see psiNormFill in cQCLayers.c
+                    tail = xPsi.shape[0] - 1
+                    while (tail > startpoints[n] and
+                           self.xVc[tail - 1] > EigenE[n] and
+                           abs(xPsi[tail - 1, n]) < abs(xPsi[tail, n]) and
+                           (xPsi[tail - 1, n] > 0) == (xPsi[tail, n] > 0)):
+                        tail -= 1
+                    xPsi[tail + 1:, n] = 0
+                Ek = EigenE - self.xVc[:, np.newaxis]
                 psiInt = np.sum(xPsi**2 * (
-                    1 + (Eq - self.xVc) / (Eq - self.xVc + self.xEg)))
-                A = 1 / sqrt(self.xres * ANG * psiInt)
-                self.xyPsi[:, p] = A * xPsi
+                    1 + Ek / (Ek + self.xEg[:, np.newaxis])), axis=0)
+                xyPsi = xPsi / sqrt(self.xres * ANG * psiInt)
 
         # remove states that come from oscillating end points
         # TODO: change to remove non-bounded states, with user options
         #       wf with non-negeligiable amplitudes higher than barrier
         #       should be removed
-        if True:
-            # looks like we should change -1 to -2 (following)???
-            #  psiEnd = self.xyPsi[-1,:]
-            #  idxs = abs(psiEnd)<10
-            #  idxs = np.nonzero(abs(psiEnd)<10)[0]
-            psiEnd = self.xyPsi[-2, :]
-            idxs = np.abs(psiEnd) < 200 / self.xres
-            # 200 depends on how precise we want about eigenenergy solver
-            # (TODO: more analysis and test about this value
-            self.EigenE = self.EigenE[idxs]
-            self.xyPsi = self.xyPsi[:, idxs]
-
-        # remove states that come from oscillating end points
-        # This doesn't really help for free levels, but accidentally removes
-        # the duplicate states on 0th layer.. (TODO)
-        psiEnd = self.xyPsi[-1, :]
-        idxs = np.nonzero(abs(psiEnd) < 10)[0]
-        self.EigenE = self.EigenE[idxs]
-        self.xyPsi = self.xyPsi[:, idxs]
-
-        # 4.5e-10 scales size of wavefunctions, arbitrary for nice plots
-        self.xyPsiPsi = self.xyPsi * self.xyPsi * wf_scale
-
+        # END_SLOPE depends on how precise we want about eigenenergy solver
+        # (TODO: more analysis and test about this value
+        # The second one doesn't really help for free levels, but
+        # accidentally removes the duplicate states on 0th layer.. (TODO)
+        vanish = np.abs(xyPsi[-1, :]) < 10
+        # wave functions of states bound at the end (below the potential
+        # there) vanish at the end, as the growing tail is cut (see
+        # psiNormFill in cQCLayers.c): every polished root of them should
+        # survive the fill, otherwise the state is dropped (below) with a
+        # warning
+        lost = ~vanish & (EigenE < self.xVc[-1])
+        if np.any(lost):
+            print "eigen state lost in filling the wave function: %s eV" % (
+                ", ".join("%.6f" % E for E in EigenE[lost]))
+        # the end wall is half a point after the last point for numerov
+        slope = np.abs(xyPsi[-2, :] - xyPsi[-1, :]) / (
+            (1.5 if numerov else 1) * self.xres)
+        keep = vanish & (slope < END_SLOPE)
+        return EigenE[keep], xyPsi[:, keep]
+
+    def solve_psi(self, Emin=None, Emax=None, nstates=None, numerov=False):
+        """ solve eigen modes
+        INPUT:
+            Emin, Emax: energy window for the eigen solver, in unit eV.
+                    Default is from min(xVc) to max(xVc) minus the field
+                    drop of 115 angstrom. A window without states gives
+                    no states, and ValueError is raised if Emin >= Emax
+            nstates: if not None, only the lowest nstates states (that are
+                    shown, see psi_post_process) above Emin are solved: the
+                    energy is scanned block by block (NSTATES_BLOCK coarse
+                    steps) and stops when enough states are found
+            numerov: if True, use Numerov method for the shooting ODE
+                    solver, which allows a coarser xres for the same
+                    precision of eigen energy: eigen energies converge as
+                    O(xres^4) for layer widths kept fixed (with an external
+                    field, up to a shift EField*xres/2 common to all
+                    states, as the potential refers to the first point
+                    while the first layer starts half a point before it)
+        OUTPUT: (doesn't return, but update member variables
+            self.EigenE is the eignenergy of the layer structure
+            self.xyPsi[x, n] is the wave function at position
+                    self.xPointsPsi[x] (= self.xPoints[x]) corresiponding
+                    to the eigenenergy EigenE[n], and without solutions near
+                    zero
+            self.xPointsPost, self.xyPsiPsi, self.xyPsiPlot are derived
+                    (lazily) for plotting, see plot_arrays
+        See solve_psi_mtr for a matrix eigen solver
+        """
+        # E0 is the reference of start point (see psi_end), independent of
+        # the energy window
+        E0 = min(self.xVc)
+        if Emin is None:
+            Emin = E0
+        if Emax is None:
+            Emax = max(self.xVc - 115 * self.EField * 1e-5)
+        if Emin >= Emax:
+            raise ValueError("empty energy window: Emin (%g eV) >= Emax "
+                             "(%g eV)" % (Emin, Emax))
+        # the last (partial) coarse interval ends exactly at Emax
+        Epoints = np.r_[np.arange(Emin, Emax, COARSE_STEP * self.vertRes /
+                                  1000), Emax]
+        nIntervals = Epoints.size - 1
+        block = nIntervals if nstates is None else NSTATES_BLOCK
+
+        EigenE, xyPsi = [], []
+        found = 0
+        for start in xrange(0, nIntervals, block):
+            end = min(start + block, nIntervals)
+            # one more coarse point at both sides as neighbours
+            lo = max(start - 1, 0)
+            brackets = self.psi_brackets(Epoints[lo:end + 2], E0, numerov,
+                                         start - lo, end - lo)
+            E, psi = self.psi_states(*(brackets + (E0, numerov)))
+            EigenE.append(E)
+            xyPsi.append(psi)
+            if nstates is not None:
+                found += np.sum(np.max(psi**2, axis=0) > wf_min_height)
+                if found >= nstates:
+                    break
+        EigenE = np.concatenate(EigenE)
+        xyPsi = np.concatenate(xyPsi, axis=1)
+        if nstates is not None:
+            # the lowest nstates states to be shown
+            idxs = np.nonzero(
+                np.max(xyPsi**2, axis=0) > wf_min_height)[0][:nstates]
+            EigenE, xyPsi = EigenE[idxs], xyPsi[:, idxs]
+
+        self.psi_post_process(EigenE, xyPsi)
+
+    def resolve_psi(self, EigenE=None, numerov=False):
+        """ Warm started solve_psi after a small change of the structure
+        (e.g. a single layer width): only narrow energy windows (WARM_WINDOW
+        coarse steps at both sides) around the previous eigen energies are
+        scanned. If any state is missing (or moves out of its window), it
+        falls back to a full solve_psi for the same number of states.
+        States appearing far from all the previous ones are not detected.
+        INPUT:
+            EigenE: previous eigen energies, default is self.EigenE (before
+                    populate_x/populate_x_band for the changed structure)
+            numerov: see solve_psi
+        OUTPUT: (doesn't return, but update member variables)
+            same as solve_psi(nstates=EigenE.size)
+        """
+        if EigenE is None:
+            EigenE = getattr(self, 'EigenE', None)
+        if EigenE is None or len(EigenE) == 0:
+            self.solve_psi(numerov=numerov)
+            return
+        EigenE = np.sort(EigenE)
+        step = COARSE_STEP * self.vertRes / 1000
+        width = WARM_WINDOW * step
+
+        # merge overlapping windows and concatenate their coarse grids
+        gaps = np.nonzero(np.diff(EigenE) > 2 * width)[0]
+        lows = EigenE[np.r_[0, gaps + 1]] - width
+        highs = EigenE[np.r_[gaps, EigenE.size - 1]] + width
+        grids = [np.arange(lo, hi + step, step) for lo, hi in
+                 zip(lows, highs)]
+        Epoints = np.concatenate(grids)
+        mask = np.ones(Epoints.size - 1, dtype=bool)
+        mask[np.cumsum([g.size for g in grids])[:-1] - 1] = False
+
+        brackets = self.psi_brackets(Epoints, min(self.xVc), numerov,
+                                     mask=mask)
+        self.psi_post_process(*self.psi_states(
+            *(brackets + (min(self.xVc), numerov))))
+        if (self.EigenE.size != EigenE.size or
+                np.any(np.abs(self.EigenE - EigenE) > width)):
+            self.solve_psi(nstates=EigenE.size, numerov=numerov)
+
+    def psi_post_process(self, EigenE, xyPsi):
+        """Post processing shared by the eigen solvers: remove states that
+        are too small to be shown, and store the solution. Arrays for
+        plotting are derived lazily, see plot_arrays
+        INPUT:
+            EigenE, xyPsi: as given by the solver
+        OUTPUT: (update member variables)
+            self.EigenE, self.xyPsi, self.xPointsPsi, self.plotStep
+        """
         # remove states that are smaller than minimum height (remove zero
         # solutions?)-test case not showing any effect
         # addresses states high above band edge
-        # 0.014 is arbitrary; changes if 4.5e-10 changes
-        #  idxs = np.nonzero(self.xyPsiPsi.max(0) >
-        #                   wf_scale * wf_min_height)[0]
-        idxs = self.xyPsiPsi.max(0) > wf_scale * wf_min_height
-        self.EigenE = self.EigenE[idxs]
-        self.xyPsi = self.xyPsi[:, idxs]
-        self.xyPsiPsi = self.xyPsiPsi[:, idxs]
-        #  self.xyPsiPsi2 = copy.deepcopy(self.xyPsiPsi)
-        self.xyPsiPlot = self.xyPsi * psi_scale
-
-        # implement pretty plot:
-        # remove long zero head and tail of the wave functions
-        # test case shows on "solve whole"
-        for q in xrange(self.EigenE.size):
-            # 0.0005 is arbitrary
-            prettyIdxs = np.nonzero(
-                self.xyPsiPsi[:, q] >
-                wf_scale * pretty_plot_factor)[0]
-            self.xyPsiPsi[0:prettyIdxs[0], q] = np.NaN
-            self.xyPsiPlot[0:prettyIdxs[0], q] = np.NaN
-            self.xyPsiPsi[prettyIdxs[-1]:, q] = np.NaN
-            self.xyPsiPlot[prettyIdxs[-1]:, q] = np.NaN
-
-        # decimate plot points: seems for better time and memory performance?
-        idxs = np.arange(0, self.xPoints.size, int(
-            plot_decimate_factor / self.xres), dtype=int)
-        #  self.xyPsiPsiDec = np.zeros((idxs.size, self.EigenE.size))
-        #  for q in xrange(self.EigenE.size):
-        #       self.xyPsiPsiDec[:, q] = self.xyPsiPsi[idxs, q]
-        #  self.xyPsiPsi = self.xyPsiPsiDec
-        self.xyPsiPsi = self.xyPsiPsi[idxs, :]
-        self.xyPsiPlot = self.xyPsiPlot[idxs, :]
-        self.xPointsPost = self.xPoints[idxs]
+        # xyPsi**2 * wf_scale > wf_scale * wf_min_height
+        idxs = np.max(xyPsi**2, axis=0) > wf_min_height
+        self.EigenE = EigenE[idxs]
+        self.xyPsi = xyPsi[:, idxs]
 
-    def solve_psi_mtr(self):
-        # TODO: a matrix eigen solver
-        pass
+        self.xPointsPsi = self.xPoints
+        self.plotStep = max(1, int(plot_decimate_factor / self.xres))
 
-    def basisSolve(self):
+    def hamiltonian_tridiag(self, xMcE):
+        """Tridiagonal finite difference Hamiltonian in unit eV
+        INPUT:
+            xMcE: effective mass at self.xPoints in unit m0
+        OUTPUT:
+            (diag, offdiag): the diagonal and off-diagonal of the matrix,
+                    for the wave function at self.xPoints[:-1]
+        The discretization is the same as psiFn in cQCLayers.c: mass is
+        linearly interpolated to half points, the wave function is zero
+        before the first point and, as the end wall of the shooting method
+        (see psi_states), at the last point.
+        """
+        # kinetic coefficient hbar^2/(2 m dx^2), e0 transforms J to eV
+        kin = hbar**2 / (2 * m0 * e0 * (self.xres * ANG)**2)
+        invMcEHalf = 1 / np.concatenate((
+            [xMcE[0]], 0.5 * (xMcE[0:-1] + xMcE[1:]), [xMcE[-1]]))
+        diag = self.xVc + kin * (invMcEHalf[0:-1] + invMcEHalf[1:])
+        offdiag = -kin * invMcEHalf[1:-1]
+        return diag[:-1], offdiag[:-1]
+
+    def mtr_eff_mass(self, E):
+        """Effective mass for the matrix solver. Same as eff_mass but the
+        kinetic energy is clipped at mid-gap, so that the mass stays positive
+        far below the band edge (where the wave function is negligible)"""
+        return self.eff_mass(self.xVc + np.maximum(E - self.xVc,
+                                                   -self.xEg / 2))
+
+    def mtr_count(self, E):
+        """Number of eigen states below energy E in the matrix solver, which
+        is the number of eigen values below E of the Hamiltonian with mass
+        evaluated at E (as lambda_k(E) - E is decreasing for every k),
+        counted by negative pivots of the Sturm sequence"""
+        diag, offdiag = self.hamiltonian_tridiag(self.mtr_eff_mass(E))
+        count = 0
+        pivot = 1.0
+        for d, o2 in zip((diag - E).tolist(), [0.0] + (offdiag**2).tolist()):
+            pivot = d - o2 / pivot
+            if pivot <= 0:
+                count += 1
+                pivot = min(pivot, -np.finfo(float).tiny)
+        return count
+
+    def mtr_newton_step(self, E, EigenE, psi):
+        """Newton step for the energy of states in the matrix solver
+        INPUT:
+            E: energy where the mass is evaluated, in unit eV
+            EigenE, psi: eigen values and (normalized) eigen vectors of the
+                    Hamiltonian with mass at E
+        OUTPUT:
+            dE: the Newton step for E = lambda(E) for each state, with
+                    dlambda/dE given by psi^T dH/dE psi (Hellmann-Feynman)
+        """
+        def rayleigh(E):
+            diag, offdiag = self.hamiltonian_tridiag(self.mtr_eff_mass(E))
+            return (np.dot(diag, psi**2) +
+                    2 * np.dot(offdiag, psi[0:-1] * psi[1:]))
+        slope = (rayleigh(E + MTR_DIFF) - rayleigh(E)) / MTR_DIFF
+        return (EigenE - E) / (1 - slope)
+
+    def mtr_inverse_iteration(self, E, psi):
+        """Polish a state of the matrix solver by inverse iteration, which is
+        much faster than solving the eigen value problem
+        INPUT:
+            E: energy of the state, close to convergence, in unit eV
+            psi: eigen vector for mass at an energy close to E (normalized,
+                    as a column)
+        OUTPUT:
+            (E, psi) of the state within MTR_TOL, or None if the iteration
+            doesn't converge to the state of the given psi (e.g. when there
+            are near-degenerate states)
+        """
+        psi0 = psi
+        for _ in xrange(MTR_MASS_ITER):
+            diag, offdiag = self.hamiltonian_tridiag(self.mtr_eff_mass(E))
+            band = np.array([np.r_[0, offdiag], diag - E, np.r_[offdiag, 0]])
+            try:
+                psi = linalg.solve_banded((1, 1), band, psi)
+            except linalg.LinAlgError:
+                return None
+            psi /= np.sqrt(np.sum(psi**2))
+            if abs(np.dot(psi0[:, 0], psi[:, 0])) < TRACK_MIN_OVERLAP:
+                return None
+            EigenE = (np.dot(diag, psi**2) +
+                      2 * np.dot(offdiag, psi[0:-1] * psi[1:]))
+            dE = self.mtr_newton_step(E, EigenE, psi)[0]
+            E += dE
+            if abs(dE) < MTR_TOL:
+                return E, psi
+        return None
+
+    def solve_psi_mtr(self, Emin=None, Emax=None):
+        """ solve eigen modes using a banded (tridiagonal) matrix eigen
+        solver, as an alternative to the shooting method of solve_psi.
+        Experimental: the states may not be the same as the ones of
+        solve_psi (see below), so state indexes (e.g. upper and lower
+        states) of the two solvers are not interchangeable
+        INPUT:
+            Emin, Emax: energy window for the eigen solver, in unit eV. Only
+                    states in this window are solved. Default is the same
+                    range as solve_psi
+        OUTPUT: (doesn't return, but update member variables)
+            self.EigenE, self.xyPsi, self.xPointsPsi, same as solve_psi
+        The energy dependence of the effective mass is taken into account by
+        Newton steps on E = lambda_k(E), where lambda_k(E) is the k-th eigen
+        value with mass evaluated at E. States are solved from low to high
+        energy, each starting with mass at the energy of the last state, and
+        polished by inverse iteration once the Newton step is below
+        MTR_INV_ITER, so that mostly two eigen solves are needed per state.
+        The index k of states in the window is exact (see mtr_count), so all
+        states in the window are solved, as in solve_psi.
+        The wave function vanishes at the last point, the end wall of
+        solve_psi, and states that don't decay towards the end (i.e. with end
+        slope larger than END_SLOPE) are removed with the same criterion as
+        in solve_psi. But the wave function starts at the first point, while
+        solve_psi starts at start_point of each energy, so the eigen
+        energies differ slightly (about 3e-5 eV, up to 1e-3 eV for states
+        close to Emax) and states with end slope close to END_SLOPE may be
+        kept by only one of the two solvers.
+        """
+        if Emin is None:
+            Emin = min(self.xVc)
+        if Emax is None:
+            Emax = max(self.xVc - 115 * self.EField * 1e-5)
+
+        # index of states in the window
+        idxLo = self.mtr_count(Emin)
+        idxHi = self.mtr_count(Emax)
+        xyPsi = np.zeros((self.xPoints.size, idxHi - idxLo))
+        EigenE = np.zeros(idxHi - idxLo)
+        E = Emin
+        for q in xrange(EigenE.size):
+            idx = idxLo + q
+            # the last state is a lower bound, and mass at its energy gives a
+            # close first guess
+            Elo, Ehi = E, Emax
+            for _ in xrange(MTR_MASS_ITER):
+                diag, offdiag = self.hamiltonian_tridiag(
+                    self.mtr_eff_mass(E))
+                lamb, psi = linalg.eigh_tridiagonal(
+                    diag, offdiag, select='i', select_range=(idx, idx))
+                if lamb[0] > E:
+                    Elo = E
+                else:
+                    Ehi = E
+                dE = self.mtr_newton_step(E, lamb, psi)[0]
+                E += dE
+                if abs(dE) < MTR_TOL:
+                    break
+                if not Elo < E < Ehi:
+                    E = (Elo + Ehi) / 2
+                elif abs(dE) < MTR_INV_ITER:
+                    polished = self.mtr_inverse_iteration(E, psi)
+                    if polished is not None:
+                        E, psi = polished
+                        break
+            EigenE[q] = E
+            psi = np.r_[psi[:, 0], 0]
+            # same sign convention as the shooting method (positive head)
+            head = np.nonzero(np.abs(psi) > 1e-3 * np.abs(psi).max())[0][0]
+            # normalization as in psiFill, Eq.(2.55) in the thesis
+            psiInt = np.sum(psi**2 * (1 + (E - self.xVc) /
+                                      (E - self.xVc + self.xEg)))
+            xyPsi[:, q] = (np.sign(psi[head]) * psi /
+                           sqrt(self.xres * ANG * psiInt))
+
+        # end slope at the same end wall as in psi_states
+        idxs = np.abs(xyPsi[-2] - xyPsi[-1]) / self.xres < END_SLOPE
+        self.psi_post_process(EigenE[idxs], xyPsi[:, idxs])
+
+    def basisSolve(self, workers=None):
         """ solve basis for the QC device, with each basis being eigen mode of
         a seperate part of the layer structure
+        INPUT:
+            workers: number of threads solving the parts in parallel, see
+                    parallel_map. Default is the number of CPUs with the
+                    single thread C library, and 1 otherwise (the OpenMP
+                    library is already parallel within each solve)
         OUTPUT:
-            dCL: a list, each element is a QCLayers class, with layer structure
-                  limited within a seperate sigle active/injection area, and
-                  layer structure in dCL also includes pedding at head/tail
-                  with same material as the first/last layer and barrier type
+            dCL: a list, each element is a BasisSegment, solved with layer
+                  structure limited within a seperate sigle active/injection
+                  area, and layer structure in dCL also includes pedding at
+                  head/tail with same material as the first/last layer and
+                  barrier type
         """
         # self.basisInjectorAR is 0-to-1
         # self.basisARInjector is 1-to-0
@@ -843,57 +1732,57 @@ class QCLayers(object):
         # it holds all of the Data classes for each individual solve section
         dCL = []
         # for first period only
-        # this handles all of the solving
+        # this handles all of the solving, with shallow copies of self: all
+        # the arrays are replaced by the update below
+        parts = []
         for n in range(len(dividers) - 1):
-            dCL.append(copy.deepcopy(self))
-            dCL[n].repeats = 1
+            part = copy.copy(self)
+            part.repeats = 1
 
-            # substitute proper layer characteristics into dCL[n], hear/tail
+            # substitute proper layer characteristics into part, hear/tail
             #  padding
             layer = range(dividers[n], dividers[n + 1] + 1)
 
-            dCL[n].layerWidth = np.concatenate(
+            part.layerWidth = np.concatenate(
                 ([int(PAD_HEAD / self.xres)], self.layerWidth[layer],
                  [int(PAD_TAIL / self.xres)]))
-            dCL[n].layerBarriers = np.concatenate(
+            part.layerBarriers = np.concatenate(
                 ([1], self.layerBarriers[layer], [1]))
-            dCL[n].layerARs = np.concatenate(
+            part.layerARs = np.concatenate(
                 ([0], self.layerARs[layer], [0]))
-            dCL[n].layerMaterials = np.concatenate(
+            part.layerMaterials = np.concatenate(
                 ([self.layerMaterials[layer][0]], self.layerMaterials[layer],
                  [self.layerMaterials[layer][-1]]))
-            dCL[n].layerDopings = np.concatenate(
+            part.layerDopings = np.concatenate(
                 ([0], self.layerDopings[layer], [0]))
-            dCL[n].layerDividers = np.concatenate(
+            part.layerDividers = np.concatenate(
                 ([0], self.layerDividers[layer], [0]))
 
-            # update and solve
-            dCL[n].update_alloys()
-            dCL[n].update_strain()
-            dCL[n].populate_x()
-            dCL[n].populate_x_band()
-            dCL[n].solve_psi()
-            print dCL[n].xVc
-
+            # update
+            part.update_alloys()
+            part.update_strain()
+            part.populate_x()
+            part.populate_x_band()
+            parts.append(part)
+
+        # the parts are independent, solve them in parallel
+        if workers is None:
+            workers = (cpu_count() if __USE_CLIB__ and
+                       not __MULTI_PROCESSING__ else 1)
+        parallel_map(lambda part: part.solve_psi(), parts, workers)
+
+        for n, part in enumerate(parts):
+            print part.xVc
             # caculate offsets
-            dCL[n].widthOffset = self.xres * np.sum(
-                self.layerWidth[range(0, dividers[n])])
-            dCL[n].fieldOffset = (-(dCL[n].widthOffset - PAD_HEAD) * ANG *
-                                  dCL[n].EField * KVpCM)
+            dCL.append(BasisSegment(part, self.xres * np.sum(
+                self.layerWidth[range(0, dividers[n])])))
 
-        # create dCL's and offsets for repeat periods
+        # create dCL's and offsets for repeat periods, sharing the solution
         period = len(dCL)
-        counter = period
-        if self.repeats > 1:
-            for q in xrange(1, self.repeats):
-                for p in xrange(0, period):
-                    dCL.append(copy.deepcopy(dCL[p]))
-                    dCL[counter].widthOffset = self.xres * np.sum(
-                        self.layerWidth[1:]) * q + dCL[p].widthOffset
-                    dCL[counter].fieldOffset = (-(dCL[counter].widthOffset -
-                                                  100) * ANG *
-                                                dCL[counter].EField * KVpCM)
-                    counter += 1
+        for q in xrange(1, self.repeats):
+            for p in xrange(0, period):
+                dCL.append(dCL[p].shift(
+                    self.xres * np.sum(self.layerWidth[1:]) * q))
         return dCL
 
     def convert_dCL_to_data(self, dCL):
@@ -904,62 +1793,42 @@ class QCLayers(object):
         OUPUT:
             get wave functions (dCL[n].xyPsi) and eigenenrgies (dCL[n].EigenE)
             in dCL and update them in self; format them in length compatibale
-            for self and update self.xyPsiPsi
+            for self (self.xPointsPsi is the position of xyPsi) and the
+            plot arrays (see plot_arrays)
             self.moduleID: moduleID[n] is the label of the position area for
                     mode self.eigenE[n] and self.xyPsi[n]
         """
-        # count number of wavefunctions
-        numWFs = sum([dC.EigenE.size for dC in dCL])
-
-        self.xPointsPost = np.arange(-PAD_HEAD, self.xPoints[-1] + PAD_TAIL +
-                                     self.xres, self.xres)
-        self.xyPsi = np.zeros((self.xPointsPost.size, numWFs))
-        self.xyPsiPsi = np.NaN * np.zeros(self.xyPsi.shape)
-        self.EigenE = np.zeros(numWFs)
-        self.moduleID = np.zeros(numWFs, dtype=np.int8)
-        counter = 0
-        for n, dC in enumerate(dCL):
-            for q in xrange(dC.EigenE.size):
-                self.EigenE[counter] = dC.EigenE[q] + dC.fieldOffset
-                self.moduleID[counter] = n
-                wf = np.zeros(self.xPointsPost.size)
-                begin = int(dC.widthOffset / self.xres)
-                end = begin + dC.xyPsi[:, q].size
-                wf[begin:end] = dC.xyPsi[:, q]
-                self.xyPsi[:, counter] = wf
-                self.xyPsiPsi[:, counter] = wf**2 * wf_scale
-                counter += 1
-
         # cut head and tial to promise the figure is in the right place?
         head = int(PAD_HEAD / self.xres)
         tail = -int(PAD_TAIL / self.xres)
-        self.xPointsPost = self.xPointsPost[head:tail]
-        self.xyPsi = self.xyPsi[head:tail]
-        self.xyPsiPsi = self.xyPsiPsi[head:tail]
-        self.xyPsiPlot = self.xyPsi * psi_scale
-
-        # implement pretty plot
-        # remove long zero head and tail of the wave functions
+        xPointsPsi = np.arange(-PAD_HEAD, self.xPoints[-1] + PAD_TAIL +
+                               self.xres, self.xres)
+        self.xPointsPsi = xPointsPsi[head:tail]
+        # no decimation for plot, pretty plot see plot_arrays
         # TODO: improve to cut according to range of well
-        for q in xrange(self.EigenE.size):
-            prettyIdxs = np.nonzero(
-                self.xyPsiPsi[:, q] >
-                wf_scale * pretty_plot_factor)[0]
-            if prettyIdxs.size != 0:
-                self.xyPsiPsi[0:prettyIdxs[0], q] = np.NaN
-                self.xyPsiPlot[0:prettyIdxs[0], q] = np.NaN
-                self.xyPsiPsi[prettyIdxs[-1]:, q] = np.NaN
-                self.xyPsiPlot[prettyIdxs[-1]:, q] = np.NaN
-            else:
-                self.xyPsiPsi[:, q] = np.NaN
-                self.xyPsiPlot[:, q] = np.NaN
+        self.plotStep = 1
+
+        # wavefunctions of each part are placed as one block, columns
+        # cols[n]:cols[n+1] are for dCL[n]
+        numWFs = [dC.EigenE.size for dC in dCL]
+        cols = np.concatenate(([0], np.cumsum(numWFs)))
+        self.EigenE = np.concatenate([dC.EigenE + dC.fieldOffset
+                                      for dC in dCL])
+        self.moduleID = np.repeat(np.arange(len(dCL)),
+                                  numWFs).astype(np.int8)
+        xyPsi = np.zeros((self.xPointsPsi.size, cols[-1]))
+        for n, dC in enumerate(dCL):
+            begin = int(dC.widthOffset / self.xres) - head
+            end = begin + dC.xyPsi.shape[0]
+            # only the part inside the cut range
+            lo, hi = max(begin, 0), min(end, xyPsi.shape[0])
+            xyPsi[lo:hi, cols[n]:cols[n + 1]] = \
+                dC.xyPsi[lo - begin:hi - begin]
 
         # sort by ascending energy
         sortID = np.argsort(self.EigenE)
         self.EigenE = self.EigenE[sortID]
-        self.xyPsi = self.xyPsi[:, sortID]
-        self.xyPsiPsi = self.xyPsiPsi[:, sortID]
-        self.xyPsiPlot = self.xyPsiPlot[:, sortID]
+        self.xyPsi = xyPsi[:, sortID]
         self.moduleID = self.moduleID[sortID]
 
         #  #decimate plot points
@@ -983,8 +1852,6 @@ class QCLayers(object):
         if upper < lower:
             upper, lower = lower, upper
 
-        psi_i = self.xyPsi[:, upper]
-        psi_j = self.xyPsi[:, lower]
         E_i = self.EigenE[upper]
         E_j = self.EigenE[lower]
         #  print "---debug---"
@@ -995,72 +1862,184 @@ class QCLayers(object):
             # LO phonon scatering doesn't happen
             return INV_INF
 
-        # zero head and tail cut off
-        idxs_i = np.nonzero(
-            psi_i > wf_scale * phonon_integral_factor)[0]
-        idxs_j = np.nonzero(
-            psi_j > wf_scale * phonon_integral_factor)[0]
-        idx_first = (idxs_i[0], idxs_j[0])
-        idx_last = (idxs_i[-1], idxs_j[-1])
-        if max(idx_first) > min(idx_last):
+        # the integral only runs over the overlap of the support windows
+        psiSparse = self.psi_sparse()
+        idx_first, idx_last, psi_i, psi_j = psiSparse.overlap(upper, lower)
+        if idx_first == idx_last:
             # wavefunction not overlap
             return INV_INF
-
-        idx_first = min(idx_first)
-        idx_last = max(idx_last)
-        psi_i = psi_i[idx_first:idx_last]
-        psi_j = psi_j[idx_first:idx_last]
         xPoints = self.xPoints[idx_first:idx_last]
 
-        xMcE_j = self.eff_mass(E_j)
-        # weight non-parabolic effective mass by probability density
-        McE_j = (m0 * np.sum(xMcE_j[idx_first:idx_last] * psi_j**2) /
-                 np.sum(psi_j**2))
-        xMcE_i = self.eff_mass(E_i)
-        # weight non-parabolic effective mass by probability density
-        McE_i = (m0 * np.sum(xMcE_i[idx_first:idx_last] * psi_i**2) /
-                 np.sum(psi_i**2))
+        # non-parabolic effective mass weighted by probability density
+        McE_j, McE_i = m0 * self.state_eff_mass()[[lower, upper]]
         #  print McE_i, McE_j
 
         # Kale's thesis Eq.(2.68)
         kl = sqrt(2 * McE_j / hbar**2 * (E_i - E_j - self.hwLO[0]) * e0)
         if __USE_CLIB__:
-            inv_tau_int = cQ.inv_tau_int
-            inv_tau_int.restype = ct.c_double
-            Iij = inv_tau_int(xPoints.size, ct.c_double(self.xres),
-                              ct.c_double(kl),
-                              xPoints.ctypes.data_as(ct.c_void_p),
-                              psi_i.ctypes.data_as(ct.c_void_p),
-                              psi_j.ctypes.data_as(ct.c_void_p))
+            psi_i = np.ascontiguousarray(psi_i)
+            psi_j = np.ascontiguousarray(psi_j)
+            Iij = cQ.inv_tau_int(xPoints.size, self.xres, kl,
+                                 xPoints.ctypes.data, psi_i.ctypes.data,
+                                 psi_j.ctypes.data)
         else:
-            dIij = np.empty(xPoints.size)
-            for n in xrange(xPoints.size):
-                x1 = xPoints[n] * ANG
-                x2 = xPoints * ANG
-                # first integral for eq.(2.69)
-                dIij[n] = np.sum(psi_i * psi_j * exp(-kl * abs(x1 - x2)) *
-                                 psi_i[n] * psi_j[n] * (self.xres * ANG)**2)
-            Iij = np.sum(dIij)
-            #  psi_corr = self.xres*ANG * psi_i * psi_j
-            #  x = np.outer(xPoints * ANG, np.ones(xPoints.size))
-            #  dIij = np.outer(psi_corr, psi_corr) * exp(-kl * np.abs(x-x.T))
-            #  Iij = np.sum(dIij)
+            # first integral for eq.(2.69): the kernel exp(-kl|x1-x2|) is
+            # separable, accumulate the x2 <= x1 part recursively (see
+            # inv_tau_int in cQCLayers.c)
+            psi_corr = psi_i * psi_j
+            acc = lfilter([1], [1, -exp(-kl * self.xres * ANG)], psi_corr)
+            Iij = np.sum(psi_corr * (2 * acc - psi_corr)) * (
+                self.xres * ANG)**2
         # looks similiar with eq.(2.69) but not exact in detail
         inverse_tau = (sqrt(McE_j * McE_i) * e0**2 * self.hwLO[0] * e0 / hbar *
                        Iij / (4 * hbar**2 * self.epsrho[0] * eps0 * kl))
         #  print "rate = %f"%(inverse_tau/1e12)
         return inverse_tau / 1e12  # to ps
 
+    def lo_rate_matrix(self, Temperature=None):
+        """ LO phonon scattering rates between all pairs of states. The
+        temperature independent parts are cached until xyPsi is replaced
+        (e.g. by a new solve)
+        INPUT:
+            Temperature: in unit K. If None, only phonon emission of
+                    electrons at the subband bottom (zero temperature), as
+                    lo_transition_rate. Otherwise both phonon emission and
+                    absorption, with the Bose factor of LO phonon, and for
+                    transitions below the threshold (E_i - E_j -/+ hwLO < 0)
+                    the electrons in the Boltzmann tail that can make it:
+                    the Boltzmann factor exp((E_i - E_j -/+ hwLO) / kT)
+                    times the form factor averaged over the thermal
+                    distribution of final kinetic energy, see lo_activated.
+                    Transitions above the threshold are from the subband
+                    bottom as for None, so the rates approach the ones of
+                    None as Temperature -> 0
+        OUTPUT:
+            rates[i, j] is the rate from state i to state j in unit 1/ps,
+            s.t. the sum of row i is the total LO phonon scattering rate of
+            state i. For Temperature None, rates[i, j] is
+            lo_transition_rate(i, j) for i > j (states are sorted by
+            energy), and zero for i <= j
+        The effective masses of each state are only computed once, and the
+        integrals of all pairs are done in one (OpenMP parallel) C call.
+        Only the occupation factors are computed for each Temperature, so
+        that sweeps of temperature (see temperature_sweep) are cheap
+        """
+        def build():
+            dE = self.EigenE[:, np.newaxis] - self.EigenE
+            emission = self.lo_form_factor(np.tril(dE - self.hwLO[0], -1))
+            absorption = self.lo_form_factor(dE + self.hwLO[0])
+            np.fill_diagonal(absorption, 0)
+            rates = emission.copy()
+            # LO phonon scattering doesn't happen or wavefunction not overlap
+            rates[np.tril(emission == 0, -1)] = INV_INF
+            # form factors for final kinetic energy on the grid of
+            # lo_activated
+            activated = {}
+            return rates, emission, absorption, activated
+        rates, emission, absorption, activated = self.solution_cache(
+            'loRates', build)
+        if Temperature is None:
+            return rates
+
+        kT = kb * Temperature / e0  # in eV
+        nLO = 1 / (exp(self.hwLO[0] / kT) - 1)
+        dE = self.EigenE[:, np.newaxis] - self.EigenE
+        activated = self.lo_activated(kT, activated)
+        dEem = dE - self.hwLO[0]
+        dEab = dE + self.hwLO[0]
+        emission = np.where(dEem > 0, emission, activated * exp(
+            np.minimum(dEem, 0) / kT))
+        absorption = np.where(dEab > 0, absorption, activated * exp(
+            np.minimum(dEab, 0) / kT))
+        rates = (nLO + 1) * emission + nLO * absorption
+        np.fill_diagonal(rates, 0)
+        return rates
+
+    def lo_activated(self, kT, grid):
+        """ LO phonon form factor F (see lo_form_factor) of all pairs of
+        states averaged over a thermal distribution of final kinetic energy
+        Ekf, i.e. the integral of F(Ekf) exp(-Ekf/kT) / kT, by Gauss-Laguerre
+        quadrature of LO_KT_NODES nodes. F at the nodes is interpolated
+        (log-log linear) between Ekf on the grid meV * LO_KT_STEP**k
+        INPUT:
+            kT: in unit eV
+            grid: dict of the form factors on the grid by k, the missing
+                    ones are computed and added
+        OUTPUT:
+            rates[i, j] in unit 1/ps, zero on the diagonal
+        """
+        n = self.EigenE.size
+        rates = np.zeros((n, n))
+        for x, w in zip(*np.polynomial.laguerre.laggauss(LO_KT_NODES)):
+            k = np.log(x * kT / meV) / np.log(LO_KT_STEP)
+            k0 = int(np.floor(k))
+            for m in (k0, k0 + 1):
+                if m not in grid:
+                    grid[m] = self.lo_form_factor(
+                        np.full((n, n), meV * LO_KT_STEP**m))
+                    np.fill_diagonal(grid[m], 0)
+            rates0, rates1 = grid[k0], grid[k0 + 1]
+            idxs = (rates0 > 0) & (rates1 > 0)
+            rates[idxs] += w * (rates0[idxs]**(k0 + 1 - k) *
+                                rates1[idxs]**(k - k0))
+        return rates
+
+    def lo_form_factor(self, Ekf):
+        """ LO phonon scattering rates between all pairs of states without
+        the phonon occupation factor, see lo_transition_rate
+        INPUT:
+            Ekf[i, j] is the kinetic energy (in unit eV) in state j after the
+                    scattering from state i, the pair is skipped if it's not
+                    positive
+        OUTPUT:
+            rates[i, j] is the rate from state i to state j in unit 1/ps,
+            zero for skipped pairs or pairs not overlapping
+        """
+        psiSparse = self.psi_sparse()
+        n = self.EigenE.size
+        # non-parabolic effective mass weighted by probability density
+        McE = m0 * self.state_eff_mass()
+        # Kale's thesis Eq.(2.68), kl[i, j] for scattering from i to j
+        kl = sqrt(2 * McE / hbar**2 * np.maximum(Ekf, 0) * e0)
+        if __USE_CLIB__:
+            Iij = np.empty((n, n))
+            # the integrals run over the support windows, with offsets of
+            # the wave functions in them
+            offset, start, stop = [
+                np.ascontiguousarray(a, dtype=np.intc) for a in
+                (psiSparse.offset[:-1] + psiSparse.intStart -
+                 psiSparse.start, psiSparse.intStart, psiSparse.intStop)]
+            cQ.inv_tau_int_matrix(n, self.xres, kl.ctypes.data,
+                                  self.xPoints.ctypes.data,
+                                  psiSparse.data.ctypes.data,
+                                  offset.ctypes.data, start.ctypes.data,
+                                  stop.ctypes.data, Iij.ctypes.data)
+        else:
+            # see lo_transition_rate
+            Iij = np.zeros((n, n))
+            for upper, lower in zip(*np.nonzero(kl)):
+                lo, hi, psi_i, psi_j = psiSparse.overlap(upper, lower)
+                psi_corr = psi_i * psi_j
+                acc = lfilter([1], [1, -exp(-kl[upper, lower] * self.xres *
+                                             ANG)], psi_corr)
+                Iij[upper, lower] = np.sum(
+                    psi_corr * (2 * acc - psi_corr)) * (self.xres * ANG)**2
+
+        rates = np.zeros((n, n))
+        idxs = Iij > 0
+        # looks similiar with eq.(2.69) but not exact in detail
+        rates[idxs] = (sqrt(McE[:, np.newaxis] * McE)[idxs] * e0**2 *
+                       self.hwLO[0] * e0 / hbar * Iij[idxs] /
+                       (4 * hbar**2 * self.epsrho[0] * eps0 * kl[idxs])
+                       ) / 1e12  # to ps
+        return rates
+
     def lo_life_time(self, state):
         """ return the life time due to LO phonon scattering of the
-        given state(label)
+        given state(label), see lo_rate_matrix
         TODO: ?what if state is a lower state and there's no coupled lower
         states?"""
-        rate = [self.lo_transition_rate(state, q)
-                for q in range(state)]
-        #  print "---debug---", rate
-        rate = sum(rate)
-        return 1 / rate
+        return 1 / np.sum(self.lo_rate_matrix()[state])
 
     def dipole(self, upper, lower):
         """ Return optical dipole between self's upper level state
@@ -1070,16 +2049,17 @@ class QCLayers(object):
         # TODO: improve performance
         if upper < lower:
             upper, lower = lower, upper
-        psi_i = self.xyPsi[:, upper]
-        psi_j = self.xyPsi[:, lower]
+        # psi is zero outside the support windows, so only their overlap
+        # (and one more point at both sides for the difference) counts
+        lo, hi, psi_i, psi_j = self.psi_sparse().overlap(upper, lower, pad=1)
         E_i = self.EigenE[upper]
         E_j = self.EigenE[lower]
 
         #  self.populate_x_band()
         # This energy dependence can be as large as -70%/+250%...
-        xMcE_i = self.eff_mass(E_i)
+        xMcE_i = self.eff_mass(E_i, lo, hi)
         #  print max(xMcE_i/self.xMc), min(xMcE_i/self.xMc)
-        xMcE_j = self.eff_mass(E_j)
+        xMcE_j = self.eff_mass(E_j, lo, hi)
         #  print xMcE_j/self.xMc
         xMcE_j_avg = 0.5 * (xMcE_j[0:-1] + xMcE_j[1:])
         psi_i_avg = 0.5 * (psi_i[0:-1] + psi_i[1:])
@@ -1091,6 +2071,32 @@ class QCLayers(object):
         # e0 transform eV to J
         return z
 
+    def dipole_matrix(self):
+        """ Optical dipoles between all pairs of states in unit angstrom,
+        cached until xyPsi is replaced (e.g. by a new solve)
+        OUTPUT:
+            z[i, j] is dipole(i, j), symmetric and zero on the diagonal
+        The sums over position in dipole are separable in the two states, so
+        they are done as matrix products over xyPsi (the momentum part is
+        antisymmetric, and z is symmetric after dividing by E_i - E_j).
+        """
+        def build():
+            psi = self.xyPsi
+            xMcE = self.eff_mass(self.EigenE[:, np.newaxis]).T
+            psiAvg = 0.5 * (psi[0:-1] + psi[1:])
+            xMcEAvg = 0.5 * (xMcE[0:-1] + xMcE[1:])
+            # Kale's (2.43) and (2.47), row i is the upper state, see dipole
+            z = (np.dot((psiAvg / xMcE[1:]).T, psi[1:]) -
+                 np.dot((psiAvg / xMcE[0:-1]).T, psi[0:-1]) +
+                 np.dot(psiAvg.T, np.diff(psi, axis=0) / xMcEAvg))
+            dE = self.EigenE[:, np.newaxis] - self.EigenE
+            np.fill_diagonal(dE, np.inf)
+            z *= hbar**2 / (2 * dE * e0 * m0) / ANG
+            z = np.tril(z, -1)
+            z += z.T
+            return z
+        return self.solution_cache('dipoles', build)
+
     def coupling_energy(self, dCL, upper, lower):
         """Calculate the coupling energy between upper level and lower level
         with levels(basis) defined in dCL
@@ -1110,12 +2116,8 @@ class QCLayers(object):
         module_j = self.moduleID[lower]
         if module_i > module_j:
             module_i, module_j = module_j, module_i
-            psi_i = self.xyPsi[:, lower]
-            psi_j = self.xyPsi[:, upper]
             Ej = self.EigenE[upper]
         else:
-            psi_i = self.xyPsi[:, upper]
-            psi_j = self.xyPsi[:, lower]
             Ej = self.EigenE[lower]
 
         # old version of coupling calculation
@@ -1135,7 +2137,7 @@ class QCLayers(object):
         # Ming's version for calculating coupling, 08.23.2017
         if module_j - module_i != 1:
             return 0
-        DeltaV = np.ones(self.xPointsPost.size)
+        DeltaV = np.ones(self.xPointsPsi.size)
         first = int(dCL[module_i].widthOffset / self.xres)
         last = first + dCL[module_i].xBarriers[
             int(PAD_HEAD / self.xres): int(PAD_TAIL / self.xres)].size
@@ -1146,25 +2148,119 @@ class QCLayers(object):
         DeltaV = 1 - DeltaV  # =is well
         jMat = int(self.xMaterials[last + 1])
         DeltaV *= (self.EcG[2 * jMat - 1] - self.EcG[2 * (jMat - 1)]) / meV
-        couplingEnergy = (np.sum(psi_i * (DeltaV + Ej) * psi_j)) * \
+        # only the overlap of the support windows counts
+        lo, hi, psi_i, psi_j = self.psi_sparse().overlap(upper, lower)
+        couplingEnergy = (np.sum(psi_i * (DeltaV[lo:hi] + Ej) * psi_j)) * \
             self.xres * ANG
         return couplingEnergy  # unit meV
 
+    def basis_hamiltonian(self, dCL):
+        """ Hamiltonian of the whole structure in the basis given by
+        basisSolve and convert_dCL_to_data (each basis state |b> is an eigen
+        state of its part, H_b |b> = E_b |b>, with potential V_b)
+        INPUT:
+            dCL: result of basisSolve(self), after convert_dCL_to_data
+        OUTPUT:
+            (H, S, Z): H[a, b] = <a|H|b> = E_b <a|b> + <a|V - V_b|b> in unit
+            eV (symmetrized), S[a, b] = <a|b> the overlap, and
+            Z[a, b] = <a|x|b> the position in unit angstrom
+        The kinetic part is the same for all the parts, the energy
+        dependence of effective mass is neglected
+        """
+        psi = self.xyPsi
+        size = min(psi.shape[0], self.xVc.size)
+        head = int(PAD_HEAD / self.xres)
+        # (V - V_b)|b>, zero outside of the part of b
+        dVPsi = np.zeros(psi.shape)
+        for n, dC in enumerate(dCL):
+            cols = np.nonzero(self.moduleID == n)[0]
+            begin = int(dC.widthOffset / self.xres) - head
+            lo, hi = max(begin, 0), min(begin + dC.xVc.size, size)
+            dV = self.xVc[lo:hi] - (dC.xVc[lo - begin:hi - begin] +
+                                    dC.fieldOffset)
+            dVPsi[lo:hi, cols] = dV[:, np.newaxis] * psi[lo:hi, cols]
+
+        dx = self.xres * ANG
+        S = np.dot(psi.T, psi) * dx
+        H = S * self.EigenE + np.dot(psi.T, dVPsi) * dx
+        H = (H + H.T) / 2
+        Z = np.dot(psi.T * self.xPointsPsi, psi) * dx
+        return H, S, Z
+
+    def basis_coupled_states(self, dCL, EField=None):
+        """ Eigen states of the whole structure from the basis Hamiltonian
+        (see basis_hamiltonian), as mixed basis states
+        INPUT:
+            dCL: see basis_hamiltonian
+            EField: external field in unit kV/cm, default self.EField. The
+                    difference from self.EField only shifts the potential
+                    by -x * (EField - self.EField), with the same basis
+        OUTPUT:
+            (EigenE, xyPsi): eigen energies in unit eV and the wave functions
+            at self.xPointsPsi
+        """
+        H, S, Z = self.basis_hamiltonian(dCL)
+        if EField is not None:
+            H = H - (EField - self.EField) * KVpCM * ANG * Z
+        EigenE, coeff = linalg.eigh(H, S)
+        return EigenE, np.dot(self.xyPsi, coeff)
+
+    def basis_field_sweep(self, dCL, fields):
+        """ Eigen energies (in unit eV) of the basis Hamiltonian at a list
+        of external fields (in unit kV/cm), with the same basis, see
+        basis_coupled_states
+        OUTPUT:
+            energies[k, n] is the n-th eigen energy at fields[k]
+        """
+        H, S, Z = self.basis_hamiltonian(dCL)
+        return np.array([
+            linalg.eigh(H - (EField - self.EField) * KVpCM * ANG * Z, S,
+                        eigvals_only=True) for EField in fields])
+
+    def anticrossing_gaps(self, dCL):
+        """ Anticrossing gaps between all pairs of basis states, in unit
+        meV: 2|H_ab| of the basis Hamiltonian after Loewdin (symmetric)
+        orthogonalization S^(-1/2) H S^(-1/2), see basis_hamiltonian
+        """
+        H, S, Z = self.basis_hamiltonian(dCL)
+        w, v = linalg.eigh(S)
+        Sinvhalf = np.dot(v / sqrt(w), v.T)
+        gaps = 2 * np.abs(np.dot(Sinvhalf, np.dot(H, Sinvhalf))) / meV
+        np.fill_diagonal(gaps, 0)
+        return gaps
+
     def broadening_energy(self, upper, lower):
         """interface roughness induced broadening: Khurgin, yentings thesis"""
         if upper < lower:
             upper, lower = lower, upper
-        psi_i = self.xyPsi[:, upper]
-        psi_j = self.xyPsi[:, lower]
+        psi_i = self.xyPsi[self.xInterfaces, upper]
+        psi_j = self.xyPsi[self.xInterfaces, lower]
+
+        psi2int2 = np.sum((psi_i**2 - psi_j**2)**2)
+        return psi2int2 * self.broadening_factor()
 
-        transitions = np.bitwise_xor(self.xBarriers[0:-1].astype(bool),
-                                     self.xBarriers[1:].astype(bool))
-        transitions = np.append(transitions, False)  # last element is not
-        psi2int2 = np.sum((psi_i[transitions]**2 - psi_j[transitions]**2)**2)
+    def broadening_matrix(self):
+        """broadening_energy (2gamma in unit meV) of all pairs of states,
+        from the wave functions at the interfaces (see populate_x)
+        OUTPUT:
+            twogamma[i, j] is broadening_energy(i, j), symmetric and zero on
+            the diagonal
+        """
+        psi2 = self.xyPsi[self.xInterfaces]**2
+        # sum((psi_i**2 - psi_j**2)**2) for all pairs
+        psi4 = np.sum(psi2**2, axis=0)
+        psi2int2 = np.maximum(psi4[:, np.newaxis] + psi4 -
+                              2 * np.dot(psi2.T, psi2), 0)
+        np.fill_diagonal(psi2int2, 0)
+        return psi2int2 * self.broadening_factor()
+
+    def broadening_factor(self):
+        """broadening_energy (in unit meV) per unit sum of
+        (psi_i**2 - psi_j**2)**2 at the interfaces"""
         DeltaLambda = 0.76 * 1e-9 * 1e-9  # 0.79nm^2
         # effective mass (self.me) update?
         twogamma = (pi * self.me[0] * m0 * e0**2 / hbar**2 * DeltaLambda**2 *
-                    (self.EcG[1] - self.EcG[0])**2 * psi2int2)
+                    (self.EcG[1] - self.EcG[0])**2)
         twogamma /= meV * e0  # convert to meV
         return twogamma
 
@@ -1174,8 +2270,9 @@ class QCLayers(object):
         dipoles = []
         gammas = []
         energies = []
+        dipoleR = self.dipole_matrix()[:, stateR]
         for q in xrange(stateR + 1, self.EigenE.size):
-            dp = self.dipole(q, stateR)
+            dp = dipoleR[q]
             if abs(dp) > 1e-6:
                 statesQ.append(q)
                 dipoles.append(dp)
@@ -1188,14 +2285,6 @@ class QCLayers(object):
         gammas = np.array(gammas) / 1000      # from meV to eV
         energies = abs(np.array(energies))  # in eV
 
-        neff = 3
-        Lp = self.xres * np.sum(self.layerWidth[1:]) * 1e-10  # in m
-        Nq = np.sum(self.layerDopings[1:] * self.layerWidth[1:]) /\
-            np.sum(self.layerWidth[1:])
-        Nq *= 100**3  # convert from cm^-3 to m^-3
-        Ns = self.xres * np.sum(self.layerDopings[1:] *
-                                self.layerWidth[1:]) * 1e11  # in cm^-2
-        Ns *= 100**2  # from cm^-2 to m^-2
         hw = self.EigenE[stateR] - self.EigenE[lower]
 
         # hw = np.arange(0.15, 0.5, 0.01)
@@ -1205,20 +2294,351 @@ class QCLayers(object):
 
         alphaISB = np.sum(energies * e0 / h / c0 * dipoles**2 * gammas /
                           ((energies - hw)**2 + gammas**2))
-        alphaISB *= 4 * pi * e0**2 / (eps0 * neff) * pi / (2 * Lp) * Ns
-        alphaISB /= e0 * 100
+        alphaISB *= self.isb_factor()
 
         return alphaISB
 
+    def isb_factor(self):
+        """The factor of the intersubband absorption (see alphaISB) that
+        doesn't depend on the transition, for all the sheet doping density
+        in one state"""
+        neff = 3
+        Lp = self.xres * np.sum(self.layerWidth[1:]) * 1e-10  # in m
+        Nq = np.sum(self.layerDopings[1:] * self.layerWidth[1:]) /\
+            np.sum(self.layerWidth[1:])
+        Nq *= 100**3  # convert from cm^-3 to m^-3
+        Ns = self.xres * np.sum(self.layerDopings[1:] *
+                                self.layerWidth[1:]) * 1e11  # in cm^-2
+        Ns *= 100**2  # from cm^-2 to m^-2
+        return 4 * pi * e0**2 / (eps0 * neff) * pi / (2 * Lp) * Ns / (
+            e0 * 100)
+
+    def sheet_density(self):
+        """Sheet doping density of one period, in unit m^-2"""
+        # layerDopings in 1e17 cm^-3 and width in angstrom = 1e-8 cm
+        Ns = self.xres * np.sum(self.layerDopings[1:] *
+                                self.layerWidth[1:]) * 1e9  # in cm^-2
+        Ns *= 100**2  # from cm^-2 to m^-2
+        return Ns
+
+    def isb_spectrum(self, hw, populations=None):
+        """Intersubband absorption spectrum of all transitions, negative for
+        gain, in unit cm^-1 (same as alphaISB)
+        INPUT:
+            hw: photon energies in unit eV, array of any shape
+            populations: populations[n] is the population of state n as a
+                    fraction of the sheet doping density, default is the
+                    Boltzmann distribution at self.Temperature
+        OUTPUT:
+            alpha: absorption at each photon energy in hw
+        With all populations in stateR, it's alphaISB(stateR, lower) at
+        hw = EigenE[stateR] - EigenE[lower] plus the stimulated emission from
+        stateR to the states below it (not counted in alphaISB)
+        """
+        hw = np.asarray(hw, dtype=float)
+        if populations is None:
+            populations = exp(-(self.EigenE - np.min(self.EigenE)) * e0 /
+                              (kb * self.Temperature))
+            populations /= np.sum(populations)
+        dipoles = self.dipole_matrix()
+        upper, lower = np.nonzero(np.tril(np.abs(dipoles) > 1e-6, -1))
+        energies = self.EigenE[upper] - self.EigenE[lower]  # in eV
+        gammas = self.broadening_matrix()[upper, lower] / 2 / 1000  # in eV
+        strength = ((populations[lower] - populations[upper]) * energies *
+                    e0 / h / c0 * (dipoles[upper, lower] * 1e-10)**2 *
+                    gammas)
+        # all transitions and photon energies in one matrix product
+        alpha = np.dot(1 / ((energies - hw.reshape(-1, 1))**2 + gammas**2),
+                       strength)
+        return alpha.reshape(hw.shape) * self.isb_factor()
+
     def figure_of_merit(self, upper, lower):
         if upper < lower:
             upper, lower = lower, upper
         tauLower = self.lo_life_time(lower)
         tauUpper = self.lo_life_time(upper)
-        tauUpperLower = 1 / self.lo_transition_rate(upper, lower)
+        tauUpperLower = 1 / self.lo_rate_matrix()[upper, lower]
         opticalDipole = self.dipole(upper, lower)
         return opticalDipole**2 * tauUpper * (1 - tauLower / tauUpperLower)
 
+    def rank_transitions(self, target_wavelength=None, tolerance=0.1,
+                         top=None, keep_all=False):
+        """ Figure of merit (see figure_of_merit) of all pairs of states,
+        from the batched dipole_matrix and lo_rate_matrix
+        INPUT:
+            target_wavelength: in unit um, if not None only transitions
+                    with wavelength within target_wavelength*(1 +/-
+                    tolerance) are ranked
+            top: number of transitions returned, default all
+            keep_all: if False and target_wavelength is None, transitions
+                    with energy below the LO phonon (their tauUpperLower is
+                    1/INV_INF, which puts near-degenerate pairs on top) or
+                    with non-finite life times are not ranked
+        OUTPUT:
+            table: np.recarray sorted by descending FoM, with fields
+                    upper, lower: state indexes
+                    energy: E_upper - E_lower in unit eV
+                    wavelength: in unit um
+                    dipole: in unit angstrom
+                    tauUpper, tauLower, tauUpperLower: LO phonon life times
+                            in unit ps, see figure_of_merit
+                    FoM: figure of merit
+        """
+        upper, lower = np.tril_indices(self.EigenE.size, -1)
+        energy = self.EigenE[upper] - self.EigenE[lower]
+        with np.errstate(divide='ignore'):
+            wavelength = h * c0 / (e0 * energy) * 1e6
+        if target_wavelength is not None:
+            idxs = (np.abs(wavelength - target_wavelength) <=
+                    tolerance * target_wavelength)
+            upper, lower = upper[idxs], lower[idxs]
+            energy, wavelength = energy[idxs], wavelength[idxs]
+
+        rates = self.lo_rate_matrix()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tau = 1 / np.sum(rates, axis=1)
+            tauUpperLower = 1 / rates[upper, lower]
+            dipole = self.dipole_matrix()[upper, lower]
+            FoM = dipole**2 * tau[upper] * (1 - tau[lower] / tauUpperLower)
+        table = np.rec.fromarrays(
+            [upper, lower, energy, wavelength, dipole, tau[upper],
+             tau[lower], tauUpperLower, FoM],
+            names=('upper', 'lower', 'energy', 'wavelength', 'dipole',
+                   'tauUpper', 'tauLower', 'tauUpperLower', 'FoM'))
+        if target_wavelength is None and not keep_all:
+            table = table[(table.energy > self.hwLO[0]) &
+                          np.isfinite(table.tauUpper) &
+                          np.isfinite(table.tauLower) &
+                          np.isfinite(table.tauUpperLower)]
+        # NaN is sorted to the end
+        order = np.argsort(-table.FoM, kind='mergesort')
+        return table[order][:top]
+
+    def map_fields(self, fields, func, workers=None, nstates=None,
+                   numerov=False):
+        """ Solve copies of self at a list of external electric fields
+        INPUT:
+            fields: electric fields in unit kV/cm
+            func: function applied to each solved copy
+            workers: number of threads solving the fields in parallel (the C
+                    solver releases the GIL), default 1
+            nstates, numerov: see solve_psi
+        OUTPUT:
+            list of func(copy) for each field
+        """
+        def solve(EField):
+            # shallow copy sharing the layer data: the position arrays are
+            # replaced by populate_x, so the solver context, the solution
+            # and its caches of the copy are rebuilt without touching self
+            qcl = copy.copy(self)
+            qcl.EField = EField
+            qcl.populate_x()
+            qcl.populate_x_band()
+            qcl.solve_psi(nstates=nstates, numerov=numerov)
+            return func(qcl)
+        return parallel_map(solve, fields, workers)
+
+    def field_sweep(self, fields, workers=None, nstates=None,
+                    numerov=False):
+        """ Solve the structure at a list of external electric fields, and
+        track the states across the fields by continuity of wave functions
+        (maximum total overlap with the previous field). self is not changed.
+        INPUT:
+            fields: electric fields in unit kV/cm, in the order of the sweep
+            workers, nstates, numerov: see map_fields
+        OUTPUT:
+            (index, energies, dipoles, lifetimes), tracked states are the
+            states solved at fields[0]; for fields[k] and tracked state s:
+            index[k, s]: index of the state in the solution at fields[k],
+                    -1 if it's lost (overlap below TRACK_MIN_OVERLAP)
+            energies[k, s]: eigen energy in unit eV
+            dipoles[k, s, t]: optical dipole between s and t in unit angstrom
+            lifetimes[k, s]: life time due to LO phonon scattering in unit
+                    ps (inf for no lower states)
+            energies, dipoles and lifetimes of lost states are NaN
+        """
+        def solution(qcl):
+            with np.errstate(divide='ignore'):
+                lifetimes = 1 / np.sum(qcl.lo_rate_matrix(), axis=1)
+            return qcl.EigenE, qcl.xyPsi, qcl.dipole_matrix(), lifetimes
+        solutions = self.map_fields(fields, solution, workers, nstates,
+                                    numerov)
+
+        # track the states by their last seen (normalized) wave functions
+        xyPsi = solutions[0][1]
+        psiTrack = xyPsi / sqrt(np.sum(xyPsi**2, axis=0))
+        index = -np.ones((len(fields), psiTrack.shape[1]), dtype=int)
+        index[0] = np.arange(psiTrack.shape[1])
+        for k in xrange(1, len(fields)):
+            xyPsi = solutions[k][1]
+            xyPsi = xyPsi / sqrt(np.sum(xyPsi**2, axis=0))
+            overlap = np.abs(np.dot(psiTrack.T, xyPsi))
+            tracks, states = linear_sum_assignment(-overlap)
+            found = overlap[tracks, states] > TRACK_MIN_OVERLAP
+            tracks, states = tracks[found], states[found]
+            index[k, tracks] = states
+            psiTrack[:, tracks] = xyPsi[:, states]
+
+        energies = np.NaN * np.zeros(index.shape)
+        dipoles = np.NaN * np.zeros(index.shape + index.shape[1:])
+        lifetimes = np.NaN * np.zeros(index.shape)
+        for k, (EigenE, _, dipole, lifetime) in enumerate(solutions):
+            tracks = np.nonzero(index[k] >= 0)[0]
+            states = index[k, tracks]
+            energies[k, tracks] = EigenE[states]
+            lifetimes[k, tracks] = lifetime[states]
+            dipoles[k, tracks[:, np.newaxis], tracks] = \
+                dipole[states[:, np.newaxis], states]
+        return index, energies, dipoles, lifetimes
+
+    def ifr_rate_matrix(self):
+        """ Interface roughness scattering rates between all pairs of
+        states, with the same roughness parameters as broadening_energy and
+        the Gaussian correlation exp(-Lambda^2 q^2 / 4) of the roughness,
+        where Lambda is IFR_LAMBDA and q the momentum transfer from the
+        bottom of the upper subband, hbar^2 q^2 / 2m* = E_i - E_j (with m*
+        of the lower state, see state_eff_mass)
+        OUTPUT:
+            rates[i, j] is the rate from state i to lower state j (i > j) in
+            unit 1/ps, and zero for i <= j
+        """
+        psi2 = self.xyPsi[self.xInterfaces]**2
+        # Lambda^2 q^2 / 4 = Lambda^2 m* (E_i - E_j) / (2 hbar^2)
+        dE = np.maximum(self.EigenE[:, np.newaxis] - self.EigenE, 0)
+        correlation = exp(-(IFR_LAMBDA * ANG)**2 * self.state_eff_mass() *
+                          m0 * dE * e0 / (2 * hbar**2))
+        # broadening_factor is in meV, hbar/(meV e0) to ps
+        rates = (np.dot(psi2.T, psi2) * correlation *
+                 self.broadening_factor() * meV * e0 / hbar / 1e12)
+        return np.tril(rates, -1)
+
+    def period_states(self):
+        """ Fold the states of the multi-period structure into the central
+        period: a state is identified by its center of probability density,
+        and a state in another period is equivalent to the state in the
+        central period with energy shifted by the field drop per period
+        OUTPUT:
+            (states, fold, shift):
+            states: indexes of the states in the central period
+            fold[n] is the index (in states) of the equivalent state of
+                    state n in the central period, -1 if there's no state
+                    within FOLD_TOL
+            shift[n] is the period of state n relative to the central one
+        """
+        Lp = self.xres * np.sum(self.layerWidth[1:])  # angstrom
+        x0 = self.xres * self.layerWidth[0]
+        psi2 = self.xyPsi**2
+        center = np.dot(self.xPointsPsi, psi2) / np.sum(psi2, axis=0)
+        shift = (np.floor((center - x0) / Lp).astype(int) -
+                 (max(self.repeats, 1) - 1) // 2)
+        states = np.nonzero(shift == 0)[0]
+        if states.size == 0:
+            return states, -np.ones(shift.size, dtype=int), shift
+        # energy drop per period, EField in kV/cm and Lp in angstrom
+        target = self.EigenE + shift * self.EField * Lp * 1e-5
+        mismatch = np.abs(target[:, np.newaxis] - self.EigenE[states])
+        fold = np.argmin(mismatch, axis=1)
+        fold[mismatch[np.arange(fold.size), fold] > FOLD_TOL] = -1
+        fold[states] = np.arange(states.size)
+        return states, fold, shift
+
+    def rate_matrices(self, ifr=False, Temperature=None):
+        """ Scattering rates from the states in the central period,
+        folded into the period (see period_states)
+        INPUT:
+            ifr: if True, interface roughness scattering is included (see
+                    ifr_rate_matrix), otherwise only LO phonon scattering
+            Temperature: for LO phonon scattering, see lo_rate_matrix
+        OUTPUT:
+            (W, D, states): W[a, b] is the total rate from states[a] to
+            (the equivalents of) states[b] in unit 1/ps; D[a, b] is the same
+            but weighted by the number of periods the electron moves
+        """
+        rates = self.lo_rate_matrix(Temperature)
+        if ifr:
+            rates = rates + self.ifr_rate_matrix()
+        states, fold, shift = self.period_states()
+        rates = rates[states][:, fold >= 0]
+        shift, fold = shift[fold >= 0], fold[fold >= 0]
+        W = np.zeros((states.size, states.size))
+        D = np.zeros((states.size, states.size))
+        for b in xrange(states.size):
+            W[:, b] = np.sum(rates[:, fold == b], axis=1)
+            D[:, b] = np.dot(rates[:, fold == b], shift[fold == b])
+        return W, D, states
+
+    def populations(self, ifr=False, Temperature=None):
+        """ Steady state populations of the states in the central period
+        from rate equations, see rate_matrices
+        OUTPUT:
+            (states, n): n[a] is the population of states[a] as a fraction
+            of the sheet doping density
+        """
+        W, D, states = self.rate_matrices(ifr, Temperature)
+        return states, steady_state([W])[0]
+
+    def current_density(self, ifr=False, Temperature=None):
+        """ Current density in unit A/cm^2 from the steady state
+        populations, see populations and rate_current"""
+        W, D, states = self.rate_matrices(ifr, Temperature)
+        n = steady_state([W])[0]
+        return self.rate_current(n, D)
+
+    def rate_current(self, n, D):
+        """Current density in unit A/cm^2 for populations n and the period
+        weighted rates D, see rate_matrices. The current is the flow of
+        electrons between periods, so it needs repeats > 1 (raise
+        ValueError otherwise)"""
+        if self.repeats < 2:
+            raise ValueError("current density needs repeats > 1, with a "
+                             "single period D is always 0")
+        # 1e12 from 1/ps to 1/s, 1e-4 from A/m^2 to A/cm^2
+        return e0 * self.sheet_density() * np.dot(n, np.sum(D, axis=1)) * (
+            1e12 * 1e-4)
+
+    def field_current(self, fields, workers=None, ifr=False,
+                      Temperature=None, nstates=None, numerov=False):
+        """ Current density in unit A/cm^2 at a list of external electric
+        fields (in unit kV/cm), see current_density. The rate equations of
+        all fields are solved together in one sparse linear solve
+        INPUT:
+            workers, nstates, numerov: see map_fields
+            ifr, Temperature: see rate_matrices
+        OUTPUT:
+            current density at each field, NaN with a single period (see
+            rate_current)
+        """
+        def matrices(qcl):
+            return qcl.rate_matrices(ifr, Temperature)[0:2]
+        mats = self.map_fields(fields, matrices, workers, nstates, numerov)
+        pops = steady_state([W for W, D in mats])
+        if self.repeats < 2:
+            return np.full(len(mats), np.nan)
+        return np.array([self.rate_current(n, D) for n, (W, D) in
+                         zip(pops, mats)])
+
+    def temperature_sweep(self, temperatures, ifr=False):
+        """ Populations and current density at a list of temperatures, with
+        the current eigen solution (the temperature independent parts of the
+        rates are reused, see lo_rate_matrix)
+        INPUT:
+            temperatures: in unit K
+            ifr: see rate_matrices
+        OUTPUT:
+            (states, populations, current): populations[k, a] is the
+            population of states[a] at temperatures[k] (see populations),
+            and current[k] the current density in unit A/cm^2 (NaN with a
+            single period, see rate_current)
+        """
+        mats = [self.rate_matrices(ifr, T) for T in temperatures]
+        pops = steady_state([W for W, D, states in mats])
+        if self.repeats < 2:
+            current = np.full(len(mats), np.nan)
+        else:
+            current = np.array([self.rate_current(n, D) for n, (W, D, states)
+                                in zip(pops, mats)])
+        return mats[0][2], np.array(pops), current
+
 
 if __name__ == "__main__":
     if __USE_CLIB__:
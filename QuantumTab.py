@@ -1171,6 +1171,8 @@ class QuantumTab(QWidget):
             step = 1 # * xres
             upper = self.stateHolder[1]
             lower = self.stateHolder[0]
+            # goal only depends on states up to upper (and lower)
+            nstates = max(upper, lower) + 1
             old_width = -1
             origin_width = new_width = self.qclayers.layerWidth[row]
             if DEBUG >= 1:
@@ -1183,18 +1185,17 @@ class QuantumTab(QWidget):
             #  while abs(old_width - new_width) >= 0.7*xres:
             while old_width != new_width :
                 # Solve for values of goal near old_width
-                # improve: only solve for eigen states near selection
                 goal_old = goals[1]
                 self.qclayers.layerWidth[row] = new_width - step
                 self.qclayers.populate_x()
                 self.qclayers.populate_x_band()
-                self.qclayers.solve_psi()
+                self.qclayers.resolve_psi(self.qclayers.EigenE[:nstates])
                 goals[0] = np.abs(goal(upper,lower))
 
                 self.qclayers.layerWidth[row] = new_width + step
                 self.qclayers.populate_x()
                 self.qclayers.populate_x_band()
-                self.qclayers.solve_psi()
+                self.qclayers.resolve_psi(self.qclayers.EigenE[:nstates])
                 goals[2] = np.abs(goal(upper,lower))
                 diff = (goals[2] - goals[0])/2
                 diff2 = goals[0] + goals[2] - 2*goals[1]
@@ -1219,7 +1220,7 @@ class QuantumTab(QWidget):
                 self.qclayers.layerWidth[row] = new_width
                 self.qclayers.populate_x()
                 self.qclayers.populate_x_band()
-                self.qclayers.solve_psi()
+                self.qclayers.resolve_psi(self.qclayers.EigenE[:nstates])
                 goal_new = np.abs(goal(upper,lower))
                 E_i = self.qclayers.EigenE[upper]
                 E_j = self.qclayers.EigenE[lower]
@@ -1237,7 +1238,7 @@ class QuantumTab(QWidget):
                     self.qclayers.layerWidth[row] = new_width
                     self.qclayers.populate_x()
                     self.qclayers.populate_x_band()
-                    self.qclayers.solve_psi()
+                    self.qclayers.resolve_psi(self.qclayers.EigenE[:nstates])
                     goal_new = np.abs(goal(upper,lower))
                     E_i = self.qclayers.EigenE[upper]
                     E_j = self.qclayers.EigenE[lower]
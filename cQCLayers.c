@@ -33,7 +33,7 @@ void psiFn(double Eq, int startpoint, int xPsiSize, double xres,
 		const double *xEp, const double *xESO, const double *xMc, 
 		double *xMcE, double *xPsi)
 { /*A ODE solver for wave function, using Euler method.  
-	(TB improve: Numerov method)
+	(See psiFnNumerov for Numerov method)
 	The formular is Eq.(2.6) in the Thesis for ODE solver
 TODO: try remove Eq
 	
@@ -94,27 +94,235 @@ RESUTL:
 	return;
 }
 
+static int sameMaterial(int q, int r, const double *xEg, const double *xF, 
+		const double *xEp, const double *xESO)
+{ /* if position q and r have the same band parameters */
+	return xEg[q] == xEg[r] && xF[q] == xF[r] 
+		&& xEp[q] == xEp[r] && xESO[q] == xESO[r];
+}
+
+typedef struct { /* parameters for psiFnNumerov */
+	double Eq, dV; 
+	int xPsiSize; 
+	const double *xVc, *xEg, *xF, *xEp, *xESO; 
+} numerovPara;
+
+static double numerovV(const numerovPara *p, int k, int r)
+{ /* potential at position k for the material at position r, 
+	linearly extended by the external field if k is in another material */
+	if(k >= 0 && k < p->xPsiSize && 
+			sameMaterial(k, r, p->xEg, p->xF, p->xEp, p->xESO))
+		return p->xVc[k];
+	return p->xVc[r] + (k - r) * p->dV;
+}
+
+static double numerovM(const numerovPara *p, double V, int r)
+{ /* effective mass by Eq.(2.20) at potential V for material at r, 
+	kinetic energy is clipped at mid-gap so that the mass stays positive 
+	far below the band edge (where the wave function is evanescent) */
+	double Ek = p->Eq - V;
+	if(Ek < -0.5*p->xEg[r]) 
+		Ek = -0.5*p->xEg[r];
+	return m0 / ( 1 + 2*p->xF[r] + p->xEp[r]/3 * (
+				2 / (Ek + p->xEg[r]) + 1 / (Ek + p->xEg[r] + p->xESO[r]) ));
+}
+
+static double numerovG(const numerovPara *p, int k, int r, double c)
+{ /* g = xres^2 * (2m(V-E)/hbar^2 + s''/s) at position k for material at r, 
+	where s = 1/sqrt(m), and c = 2*(xres/hbar)^2*e0 */
+	double V = numerovV(p, k, r); 
+	double m = numerovM(p, V, r);
+	return c * m * (V - p->Eq) 
+		+ sqrt(m / numerovM(p, numerovV(p, k+1, r), r)) - 2 
+		+ sqrt(m / numerovM(p, numerovV(p, k-1, r), r));
+}
+
 #ifdef _WINDLL
 	__declspec(dllexport)
 #endif // _WINDLL
-int psiFnEnd(const double *eEq, int eEqSize, int xPsiSize, double xres, 
-		double EField, const double *xVc, const double *xEg, const double *xF, 
+void psiFnNumerov(double Eq, int startpoint, int xPsiSize, double xres, 
+		const double *xVc, const double *xEg, const double *xF, 
 		const double *xEp, const double *xESO, const double *xMc, 
-		double *xMcE, double *xPsi, double *xPsiEnd)
+		double *xMcE, double *xPsi)
+{ /*A ODE solver for wave function, using Numerov method. 
+	With s = 1/sqrt(m), u = xPsi*s satisfies u'' = g/xres^2 * u, with 
+		g = xres^2 * (2m(V-E)/hbar^2 + s''/s)
+	which has no first derivative term and is solved by Numerov method 
+	inside each layer. Band parameters change between two points at an 
+	interface (assumed at the half point): u is extended to the next point 
+	by the same material, interpolated to the interface to O(xres^4), 
+	matched by continuity of xPsi and xPsi'/m, and expanded to the two 
+	points around the interface for the new material. 
+	As layers end at half points, the walls of the structure are also at 
+	half points: half a point before startpoint-1 (where psiFn has its 
+	zero) and after the last point, s.t. the boundaries don't move 
+	relative to the layers with xres. 
+
+INPUT/OUTPUT: same as psiFn, except that 
+	xMcE[x] is the effective mass at position x (not half point)
+	xPsi[xPsiSize-1] is the wave function at the end wall (half a point 
+		after the last point), which is zero for an eigen state
+	*/
+	const double c = 2*sq(xres*ANG/hbar)*e0;
+	numerovPara p = {Eq, 0, xPsiSize, xVc, xEg, xF, xEp, xESO};
+	for(int q=0; q<xPsiSize-1; q++)
+		/* potential drop per point by external field */
+		if(sameMaterial(q, q+1, xEg, xF, xEp, xESO))
+		{
+			p.dV = xVc[q+1] - xVc[q];
+			break;
+		}
+	for(int q=0; q<xPsiSize; q++)
+		xMcE[q] = numerovM(&p, xVc[q], q);
+
+	/* first point after the start wall */
+	int s = startpoint - 1;
+	for(int q=0; q<s; q++) 
+		xPsi[q] = 0; 
+	xPsi[s] = 1;
+	/* r is a position in current material, u and g at q-1, q 
+	 * (xPsi = 1 at s is a choice of scale) */
+	int r = s;
+	double g0 = numerovG(&p, s-1, r, c), g1 = numerovG(&p, s, r, c), g2;
+	/* u = 0 at the start wall, interpolated as uMid below */
+	double uCur = 1/sqrt(xMcE[s]);
+	double uPrev = -uCur * (8 - g1) / (8 - g0);
+	for(int q=s; q<xPsiSize-1; q++)
+	{
+		if(q+2 < xPsiSize && sameMaterial(q, q+2, xEg, xF, xEp, xESO) 
+				&& sameMaterial(q+1, q+2, xEg, xF, xEp, xESO))
+			/* inside a layer */
+			g2 = c * xMcE[q+1] * (xVc[q+1] - Eq) 
+				+ sqrt(xMcE[q+1]/xMcE[q+2]) - 2 + sqrt(xMcE[q+1]/xMcE[q]);
+		else
+			g2 = numerovG(&p, q+1, r, c);
+		/* Numerov for current material */
+		double uNext = (2*(1 + 5*g1/12) * uCur - (1 - g0/12) * uPrev) 
+			/ (1 - g2/12);
+		if(sameMaterial(q+1, r, xEg, xF, xEp, xESO))
+		{
+			uPrev = uCur; uCur = uNext; 
+			g0 = g1; g1 = g2;
+		}
+		else
+		{ /* interface between q and q+1 */
+			/* u and xres*u' at the interface, from material at r */
+			double uMid = 0.5*(uCur + uNext) - (g1*uCur + g2*uNext)/16;
+			double duMid = uNext - uCur - (g2*uNext - g1*uCur)/24;
+			double mA = numerovM(&p, numerovV(&p, q, r) + 0.5*p.dV, r);
+			double sA = 1/sqrt(mA);
+			double dsA = 1/sqrt(numerovM(&p, numerovV(&p, q+1, r), r)) 
+				- 1/sqrt(xMcE[q]);
+			/* xPsi and xres*xPsi'/m, continuous at the interface */
+			double psi = uMid / sA;
+			double flux = (duMid/sA - uMid*dsA/(sA*sA)) / mA;
+			/* u and xres*u' at the interface, for material at q+1 */
+			r = q+1;
+			double mB = numerovM(&p, numerovV(&p, q+1, r) - 0.5*p.dV, r);
+			double sB = 1/sqrt(mB);
+			double dsB = 1/sqrt(xMcE[q+1]) 
+				- 1/sqrt(numerovM(&p, numerovV(&p, q, r), r));
+			uMid = psi * sB;
+			duMid = flux * mB * sB + psi * dsB;
+			/* Taylor expansion to q and q+1 for the new material */
+			g0 = numerovG(&p, q, r, c);
+			g1 = numerovG(&p, q+1, r, c);
+			double gMid = 0.5*(g0 + g1);
+			double even = uMid + gMid*uMid/8 + sq(gMid)*uMid/384;
+			double odd = duMid/2 + ((g1 - g0)*uMid + gMid*duMid)/48;
+			uPrev = even - odd; 
+			uCur = even + odd;
+		}
+		xPsi[q+1] = uCur * sqrt(xMcE[q+1]);
+		if(fabs(uCur) > 1e100)
+		{ /* rescale to avoid overflow, as the scale is arbitrary */
+			for(int k=s; k<=q+1; k++)
+				xPsi[k] *= 1e-100;
+			uPrev *= 1e-100;
+			uCur *= 1e-100;
+		}
+	}
+	/* one more point for material at r, and interpolate to the end wall */
+	int q = xPsiSize - 1;
+	g2 = numerovG(&p, q+1, r, c);
+	double uNext = (2*(1 + 5*g1/12) * uCur - (1 - g0/12) * uPrev) 
+		/ (1 - g2/12);
+	double uEnd = 0.5*(uCur + uNext) - (g1*uCur + g2*uNext)/16;
+	xPsi[q] = uEnd * sqrt(numerovM(&p, numerovV(&p, q, r) + 0.5*p.dV, r));
+	return;
+}
+
+#define NUMEROV 1 /* scheme label for psiFnNumerov, otherwise psiFn */
+typedef void (*psiFnType)(double, int, int, double, 
+		const double *, const double *, const double *, 
+		const double *, const double *, const double *, 
+		double *, double *);
+
+static psiFnType psiScheme(int scheme)
+{ /* select the ODE solver for wave function */
+	return scheme == NUMEROV ? psiFnNumerov : psiFn;
+}
+
+static int startPoint(double Eq, double E0, int xPsiSize, double xres, 
+		double EField)
+{ /* start point for psiFn, according to energy offset Eq-E0 and external 
+	field EField (kV/cm), s.t. the wave function starts in the barrier 
+	before the first well it can be confined in */
+	const double extLength=200; /*angstrom, the extend length for start point*/ 
+	int startpoint;
+	if(EField <= 0) 
+		return 1;
+	startpoint = xPsiSize - ceil(
+			(Eq - E0)/(EField * KVpCM * ANG * xres) + extLength/xres);
+	if(startpoint<1) 
+		startpoint = 1;
+	if(startpoint>xPsiSize-2) 
+		startpoint = xPsiSize-2;
+	return startpoint;
+}
+
+static int psiNodes(const double *xPsi, int startpoint, int xPsiSize)
+{ /* number of sign changes of xPsi from startpoint to the end (including 
+	the end point), i.e. the number of eigenenergies below Eq for the 
+	structure starting from startpoint (oscillation theorem) */
+	int nodes = 0;
+	double last = xPsi[startpoint];
+	for(int q=startpoint+1; q<xPsiSize; q++)
+		if(xPsi[q] != 0)
+		{
+			if((xPsi[q] > 0) != (last > 0))
+				nodes++;
+			last = xPsi[q];
+		}
+	return nodes;
+}
+
+#ifdef _WINDLL
+	__declspec(dllexport)
+#endif // _WINDLL
+int psiFnEnd(const double *eEq, int eEqSize, double E0, int xPsiSize, 
+		double xres, double EField, int scheme, const double *xVc, 
+		const double *xEg, const double *xF, const double *xEp, 
+		const double *xESO, const double *xMc, double *xMcE, double *xPsi, 
+		double *xPsiEnd, numpyint *xPsiNodes)
 { /*To get boundary dependence of energy Eq (Fig.2.1 left in the thesis) 
 	to help decide the eigenvalue for zero boundary condition 
  
 INPUT:
 	eEq[n] is the required energy series
 	eEqSize is the size of eEq
+	E0 is the reference energy for start point (the lowest energy to scan)
 	xPsiSize, xres, xVc, ..., xPsi are parameters for psiFn
 	EField is static external electrical field, in unit kV/cm
+	scheme is the ODE solver, NUMEROV for psiFnNumerov, otherwise psiFn
 
 OUTPUT:
 	xPsiEnd is wavefunction (non-normalized) at the end, 
 		supposed to be 0 for eigenenergy 
+	xPsiNodes (if not NULL) is the number of nodes of the wavefunction, 
+		which increases by one at each eigenenergy, see psiNodes
   */
-	const double extLength=200; /*nm, the extend length for start point*/ 
+	psiFnType fn = psiScheme(scheme);
 	int q;
 #ifdef __MP
 #pragma omp parallel private(xMcE, xPsi)
@@ -125,18 +333,15 @@ OUTPUT:
 #endif
 	for(q=0; q<eEqSize; q++)
 	{
-#ifdef __MP
-#endif
 		double Eq = eEq[q];
 		/* set start point, according to energy offset and external field */
-		int startpoint = xPsiSize - ceil(
-				(Eq - eEq[0])/(EField * KVpCM * ANG * xres) + extLength/xres);
-		if(startpoint<1) 
-			startpoint = 1;
+		int startpoint = startPoint(Eq, E0, xPsiSize, xres, EField);
 
-		psiFn(Eq, startpoint, xPsiSize, xres, 
+		fn(Eq, startpoint, xPsiSize, xres, 
 				xVc, xEg, xF, xEp, xESO, xMc, xMcE, xPsi);
 		xPsiEnd[q] = xPsi[xPsiSize-1];
+		if(xPsiNodes != NULL)
+			xPsiNodes[q] = psiNodes(xPsi, startpoint, xPsiSize);
 		//printf("%d: %g %d        ", q, eEq[q], startpoint);
 		//printf("%d  ", startpoint);
 	}
@@ -149,6 +354,180 @@ OUTPUT:
 	return 1;
 }
 
+static double psiRoot(double a, double b, double E0, double tol, 
+		int xPsiSize, double xres, double EField, psiFnType fn, 
+		const double *xVc, const double *xEg, const double *xF, 
+		const double *xEp, const double *xESO, const double *xMc, 
+		double *xMcE, double *xPsi)
+{ /* Illinois (modified regula falsi) method on the wavefunction at the 
+	end for the eigen energy in [a, b], see psiFnRoots. 
+	It stops when the bracket is shorter than tol, or can't be split any 
+	more (to the round off, as the wave function is filled from the root, 
+	see psiNormFill) */
+	const int maxIter = 100;
+	double fa, fb, c, fc;
+	int side = 0;
+	fn(a, startPoint(a, E0, xPsiSize, xres, EField), xPsiSize, xres, 
+			xVc, xEg, xF, xEp, xESO, xMc, xMcE, xPsi);
+	fa = xPsi[xPsiSize-1];
+	fn(b, startPoint(b, E0, xPsiSize, xres, EField), xPsiSize, xres, 
+			xVc, xEg, xF, xEp, xESO, xMc, xMcE, xPsi);
+	fb = xPsi[xPsiSize-1];
+	double root = fabs(fa) < fabs(fb) ? a : b;
+	for(int it=0; it<maxIter && b - a >= tol; it++)
+	{
+		c = (a*fb - b*fa) / (fb - fa);
+		if(!(c > a && c < b)) 
+			/* overflow or round off, fall back to bisection */
+			c = 0.5*(a + b);
+		if(!(c > a && c < b)) 
+			/* a and b are next to each other */
+			break;
+		fn(c, startPoint(c, E0, xPsiSize, xres, EField), xPsiSize, 
+				xres, xVc, xEg, xF, xEp, xESO, xMc, xMcE, xPsi);
+		fc = xPsi[xPsiSize-1];
+		root = c;
+		if(fc == 0)
+			break;
+		if((fc > 0) == (fb > 0))
+		{ /* root in [a, c] */
+			b = c; fb = fc;
+			if(side == -1) 
+				fa /= 2;
+			side = -1;
+		}
+		else
+		{ /* root in [c, b] */
+			a = c; fa = fc;
+			if(side == 1) 
+				fb /= 2;
+			side = 1;
+		}
+	}
+	return root;
+}
+
+static void psiNormFill(double Eq, int startpoint, int xPsiSize, 
+		double xres, psiFnType fn, const double *xVc, const double *xEg, 
+		const double *xF, const double *xEp, const double *xESO, 
+		const double *xMc, double *xMcE, double *xPsi)
+{ /* normalized wave function at eigen energy Eq, starting from startpoint 
+	(the same as for the eigen energy), see psiFill */
+	fn(Eq, startpoint, xPsiSize, xres, xVc, xEg, xF, xEp, xESO, xMc, xMcE, 
+			xPsi);
+	/* The eigen energy is only precise to the round off, so the solution 
+	 * picks up the growing exponential in the barrier at the end. It is 
+	 * cut at the minimum of |xPsi|, where the decaying part takes over. 
+	 * (An oscillating end, i.e. not a bound state, is not changed) */
+	int tail = xPsiSize - 1;
+	while(tail > startpoint && xVc[tail-1] > Eq 
+			&& fabs(xPsi[tail-1]) < fabs(xPsi[tail]) 
+			&& (xPsi[tail-1] > 0) == (xPsi[tail] > 0))
+		tail--;
+	if(tail < xPsiSize - 1)
+		for(int q=tail+1; q<xPsiSize; q++)
+			xPsi[q] = 0;
+	/* Normalization */
+	/*double PsiInt = 1; //one for xPsi[1]
+	for(int q=1; q<xPsiSize-1; q++)
+	{ 
+		PsiInt += sq(xPsi[q]) * ( 1 + ( Eq-xVc[q] ) / ( Eq-xVc[q]+xEg[q] ) );
+	}*/
+	/* TODO: positive charge holes? */
+	double PsiInt = 0; 
+	for(int q=0; q<xPsiSize; q++) 
+		/*Usual normalization*/
+		/* PsiInt += sq(xPsi[q]);  */
+		/* Eq.(2.55) in the thesis*/
+		PsiInt += sq(xPsi[q]) * (
+					1 + ( Eq - xVc[q] ) / ( Eq - xVc[q] + xEg[q] ) );
+	double NormFactor = 1 / sqrt(xres * ANG * PsiInt);
+
+	for(int q=0; q<xPsiSize; q++)
+		xPsi[q] *= NormFactor;
+}
+
+#ifdef _WINDLL
+	__declspec(dllexport)
+#endif // _WINDLL
+int psiFnRoots(const double *Elo, const double *Ehi, int rootSize, 
+		double E0, double tol, int xPsiSize, double xres, double EField, 
+		int scheme, const double *xVc, const double *xEg, const double *xF, 
+		const double *xEp, const double *xESO, const double *xMc, 
+		double *xMcE, double *xPsi, double *root)
+{ /* Polish eigen energies bracketed by [Elo[n], Ehi[n]] using Illinois 
+	(modified regula falsi) method on the wavefunction at the end, 
+	with the same start point as psiFnEnd
+ 
+INPUT:
+	Elo[n], Ehi[n] bracket the n-th eigen energy, i.e. xPsi[end] has 
+		different sign at Elo[n] and Ehi[n]; with length rootSize
+	E0 is the reference energy for start point, see psiFnEnd
+	tol is the tolerance of the eigen energy, in eV
+	others see psiFnEnd
+
+OUTPUT:
+	root[n] is the eigen energy in [Elo[n], Ehi[n]] */
+	psiFnType fn = psiScheme(scheme);
+	int q;
+#ifdef __MP
+#pragma omp parallel private(xMcE, xPsi)
+	{
+		xMcE = (double *)malloc(xPsiSize * sizeof(double));
+		xPsi = (double *)malloc(xPsiSize * sizeof(double));
+#pragma omp for
+#endif
+	for(q=0; q<rootSize; q++)
+		root[q] = psiRoot(Elo[q], Ehi[q], E0, tol, xPsiSize, xres, EField, 
+				fn, xVc, xEg, xF, xEp, xESO, xMc, xMcE, xPsi);
+#ifdef __MP
+		free(xMcE);
+		free(xPsi);
+	}
+#endif
+	return 1;
+}
+
+#ifdef _WINDLL
+	__declspec(dllexport)
+#endif // _WINDLL
+int psiRootsFill(const double *Elo, const double *Ehi, int rootSize, 
+		double E0, double tol, int xPsiSize, double xres, double EField, 
+		int scheme, const double *xVc, const double *xEg, const double *xF, 
+		const double *xEp, const double *xESO, const double *xMc, 
+		double *xMcE, double *xPsi, double *root, double *xyPsi)
+{ /* psiFnRoots followed by psiFill, in one loop over states 
+	(parallel for multi-processing)
+INPUT: see psiFnRoots
+OUTPUT:
+	root[n] is the eigen energy in [Elo[n], Ehi[n]]
+	xyPsi[n*xPsiSize: (n+1)*xPsiSize] is the (normalized) wave function 
+		corresponding to root[n] */
+	psiFnType fn = psiScheme(scheme);
+	int q;
+#ifdef __MP
+#pragma omp parallel private(xMcE, xPsi)
+	{
+		xMcE = (double *)malloc(xPsiSize * sizeof(double));
+		xPsi = (double *)malloc(xPsiSize * sizeof(double));
+#pragma omp for schedule(dynamic)
+#endif
+	for(q=0; q<rootSize; q++)
+	{
+		root[q] = psiRoot(Elo[q], Ehi[q], E0, tol, xPsiSize, xres, EField, 
+				fn, xVc, xEg, xF, xEp, xESO, xMc, xMcE, xPsi);
+		psiNormFill(root[q], startPoint(root[q], E0, xPsiSize, xres, EField), 
+				xPsiSize, xres, fn, xVc, xEg, xF, xEp, xESO, xMc, xMcE, 
+				xyPsi + q*xPsiSize);
+	}
+#ifdef __MP
+		free(xMcE);
+		free(xPsi);
+	}
+#endif
+	return 1;
+}
+
 #ifdef _WINDLL
 	__declspec(dllexport)
 #endif // _WINDLL
@@ -183,40 +562,35 @@ OUTPUT:
 __declspec(dllexport)
 #endif // _WINDLL
 int psiFill(int xPsiSize, double xres, int EigenESize, const double *EigenE, 
-		const double *xVc, const double *xEg, const double *xF, 
-		const double *xEp, const double *xESO, const double *xMc, 
-		double *xMcE, double *xyPsi)
+		double E0, double EField, int scheme, const double *xVc, 
+		const double *xEg, const double *xF, const double *xEp, 
+		const double *xESO, const double *xMc, double *xMcE, double *xyPsi)
 { /* To calculate a series of wave function according to given eigen energy
 INPUT:
 	EigenE[n] is the n-th eigen-energy, with length EigenESize
+	E0, EField decide the start point (the same as for the eigen energy), 
+		see psiFnEnd
+	scheme is the ODE solver, see psiFnEnd
 	others see psiFn
 OUTPUT:
 	xyPsi[n] is the wave function corresponding to EigenE[n] */
-	for(int col=0; col<EigenESize; col++) // loop on column
+	psiFnType fn = psiScheme(scheme);
+	int col;
+#ifdef __MP
+#pragma omp parallel private(xMcE)
 	{
-		double Eq = EigenE[col];
-		psiFn(Eq, 1, xPsiSize, xres, xVc, xEg, xF, xEp, xESO, xMc, xMcE, 
-				xyPsi+col*xPsiSize);
-		/* Normalization */
-		/*double PsiInt = 1; //one for xPsi[1]
-		for(int q=1; q<xPsiSize-1; q++)
-		{ 
-			PsiInt += sq(xyPsi[q+col*xPsiSize]) * ( 
-					1 + ( Eq-xVc[q] ) / ( Eq-xVc[q]+xEg[q] ) );
-		}*/
-		/* TODO: positive charge holes? */
-		double PsiInt = 0; 
-		for(int q=0; q<xPsiSize; q++) 
-			/*Usual normalization*/
-			/* PsiInt += sq(xyPsi[col*xPsiSize + q]);  */
-			/* Eq.(2.55) in the thesis*/
-			PsiInt += sq(xyPsi[col*xPsiSize + q]) * (
-						1 + ( Eq - xVc[q] ) / ( Eq - xVc[q] + xEg[q] ) );
-		double NormFactor = 1 / sqrt(xres * ANG * PsiInt);
-
-		for(int q=0; q<xPsiSize; q++)
-			xyPsi[col*xPsiSize+q] *= NormFactor;
+		xMcE = (double *)malloc(xPsiSize * sizeof(double));
+#pragma omp for
+#endif
+	for(col=0; col<EigenESize; col++) // loop on column
+		psiNormFill(EigenE[col], 
+				startPoint(EigenE[col], E0, xPsiSize, xres, EField), 
+				xPsiSize, xres, fn, xVc, xEg, xF, xEp, xESO, xMc, xMcE, 
+				xyPsi + col*xPsiSize);
+#ifdef __MP
+		free(xMcE);
 	}
+#endif
 	return 1;
 }
 
@@ -227,19 +601,60 @@ double inv_tau_int(int xPsiSize, double xres, double kl,
 		const double * xPoints, const double *psi_i, const double *psi_j) {
 	/* To calculate the LO phonon life time between two given wave functions,
 	 * The integral part
-	 * see Eq.(2.65) in Kale's*/
+	 * see Eq.(2.65) in Kale's
+	 * The kernel exp(-kl|xi-xj|) is separable, so the double sum is
+	 * 2 sum_{j<=i} - sum_{j=i}, and sum_{j<=i} is accumulated recursively:
+	 * acc_i = psi_i psi_j (xi) + exp(-kl(xi - x_{i-1})) acc_{i-1}  */
 	double Iij = 0;
+	double acc = 0;
+	int i;
+	for(i=0; i < xPsiSize; i++){
+		double f = psi_i[i]*psi_j[i];
+		if(i > 0)
+			acc *= exp(-kl*ANG*(xPoints[i] - xPoints[i-1]));
+		acc += f;
+		Iij += f * (2*acc - f);
+	}
+	return Iij * sq(xres*ANG);
+}
+
+
+#ifdef _WINDLL
+__declspec(dllexport)
+#endif // _WINDLL
+int inv_tau_int_matrix(int EigenESize, double xres, const double *kl, 
+		const double *xPoints, const double *psi, const int *offset, 
+		const int *start, const int *stop, double *Iij) {
+	/* inv_tau_int for all pairs of states
+INPUT:
+	kl[i*EigenESize + j] is kl for state i to state j, the pair is skipped 
+		(Iij = 0) if it's not positive
+	psi, offset, start, stop are the wave functions in their support windows 
+		(see SparsePsi in QCLayers.py): the wave function of state n on 
+		xPoints[start[n]:stop[n]] is psi[offset[n]:offset[n+1]], and zero 
+		outside
+OUTPUT:
+	Iij[i*EigenESize + j] is the integral between state i and j, only the 
+		overlap of the support windows counts */
 	int i;
 #ifdef __MP
-#pragma omp parallel for reduction(+:Iij)
+#pragma omp parallel for schedule(dynamic)
 #endif
-	for(i=0; i < xPsiSize; i++){
-		for(int j=0; j < xPsiSize; j++){
-			Iij += psi_i[i]*psi_j[i] * exp(-kl*ANG*fabs(xPoints[i] - xPoints[j]))
-					* psi_i[j] * psi_j[j]; 
+	for(i=0; i<EigenESize; i++) {
+		for(int j=0; j<EigenESize; j++) {
+			int lo = start[i] > start[j] ? start[i] : start[j];
+			int hi = stop[i] < stop[j] ? stop[i] : stop[j];
+			if(kl[i*EigenESize + j] <= 0 || lo >= hi) {
+				Iij[i*EigenESize + j] = 0;
+				continue;
+			}
+			Iij[i*EigenESize + j] = inv_tau_int(hi - lo, xres, 
+					kl[i*EigenESize + j], xPoints + lo, 
+					psi + offset[i] + lo - start[i], 
+					psi + offset[j] + lo - start[j]);
 		}
 	}
-	return Iij * sq(xres*ANG);
+	return 1;
 }
 
 
@@ -27,6 +27,7 @@
 
 from __future__ import division
 import numpy as np
+from scipy.constants import e as e0, c as c0, h
 from QCLayers import QCLayers
 import sys
 import cProfile
@@ -55,12 +56,18 @@ def check_class(a, b):
             equal = (item == getattr(b,key))
         print key, equal
 
-def main(qclayers):
+def main(qclayers, upper=19, lower=15):
     qclayers.solve_psi()
-    upper = 19
-    lower = 15
     FoM = qclayers.figure_of_merit(upper, lower)
     print FoM
+    # candidate transitions around the wavelength of the given pair
+    wavelength = h*c0/(e0*(qclayers.EigenE[upper] -
+                           qclayers.EigenE[lower]))*1e6
+    table = qclayers.rank_transitions(wavelength, top=5)
+    print "upper lower wl(um)  dipole(A)  FoM"
+    for row in table:
+        print "%5d %5d %6.2f %10.3f %10.3f"%(row.upper, row.lower,
+                row.wavelength, row.dipole, row.FoM)
 
 if __name__  == "__main__":
     if not len(sys.argv) in (2,3):
@@ -17,9 +17,6 @@ wf_min_height = 3.1e7
 # wf_scale * pretty_plot_factor = 5e-3
 pretty_plot_factor = 1.2e6
 
-# wavefunction height to begin intgration for LO phonon lifetime
-phonon_integral_factor = pretty_plot_factor/10
-
 # decimate factor depends on xres
 # decimate factor should be an integer
 # represents plotting wavefunctions at every xth angstrom